@@ -0,0 +1,497 @@
+/*
+ * Native fast path for hdr.py.
+ *
+ * Ports of the hdr_* recording and query functions over the struct
+ * hdr_histogram layout shared by every hdr.py backend. The functions take a
+ * Handle, whose address points to the struct, so they are called directly
+ * from Python without the ctypes argument conversions. The bulk functions
+ * release the GIL.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <structmember.h>
+
+#include <math.h>
+#include <stdbool.h>
+#include <stdint.h>
+
+/* <hdr_histogram.h>, the same layout as hdr.HistogramStruct */
+struct hdr_histogram {
+    int64_t lowest_trackable_value;
+    int64_t highest_trackable_value;
+    int64_t unit_magnitude;
+    int64_t significant_figures;
+    int32_t sub_bucket_half_count_magnitude;
+    int32_t sub_bucket_half_count;
+    int64_t sub_bucket_mask;
+    int32_t sub_bucket_count;
+    int32_t bucket_count;
+    int64_t min_value;
+    int64_t max_value;
+    int32_t normalizing_index_offset;
+    double conversion_ratio;
+    int32_t counts_len;
+    int64_t total_count;
+    int64_t *counts;
+};
+
+typedef struct {
+    PyObject_HEAD
+    unsigned long long address;
+} Handle;
+
+static PyMemberDef handle_members[] = {
+    {"address", T_ULONGLONG, offsetof(Handle, address), 0, "address of the struct hdr_histogram"},
+    {NULL}
+};
+
+static PyTypeObject HandleType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "_hdr.Handle",
+    .tp_basicsize = sizeof(Handle),
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
+    .tp_doc = "Base class of the histogram handles used with the _hdr functions",
+    .tp_members = handle_members,
+    .tp_new = PyType_GenericNew,
+};
+
+static struct hdr_histogram *histogram_of(PyObject *handle)
+{
+    if (!PyObject_TypeCheck(handle, &HandleType)) {
+        PyErr_SetString(PyExc_TypeError, "expected a _hdr.Handle");
+        return NULL;
+    }
+
+    if (((Handle *) handle)->address == 0) {
+        PyErr_SetString(PyExc_ValueError, "the handle has no histogram");
+        return NULL;
+    }
+
+    return (struct hdr_histogram *) (uintptr_t) ((Handle *) handle)->address;
+}
+
+/* layout, ports of the hdr_histogram.c static functions */
+
+static int32_t get_bucket_index(const struct hdr_histogram *h, int64_t value)
+{
+    int32_t pow2ceiling = 64 - __builtin_clzll((uint64_t) (value | h->sub_bucket_mask));
+    return pow2ceiling - (int32_t) h->unit_magnitude - (h->sub_bucket_half_count_magnitude + 1);
+}
+
+static int32_t get_sub_bucket_index(int64_t value, int32_t bucket_index, int32_t unit_magnitude)
+{
+    return (int32_t) (value >> (bucket_index + unit_magnitude));
+}
+
+static int32_t counts_index(const struct hdr_histogram *h, int32_t bucket_index, int32_t sub_bucket_index)
+{
+    int32_t bucket_base_index = (bucket_index + 1) << h->sub_bucket_half_count_magnitude;
+    int32_t offset_in_bucket = sub_bucket_index - h->sub_bucket_half_count;
+    return bucket_base_index + offset_in_bucket;
+}
+
+static int32_t counts_index_for(const struct hdr_histogram *h, int64_t value)
+{
+    int32_t bucket_index = get_bucket_index(h, value);
+    int32_t sub_bucket_index = get_sub_bucket_index(value, bucket_index, (int32_t) h->unit_magnitude);
+    return counts_index(h, bucket_index, sub_bucket_index);
+}
+
+static int64_t value_at_index(const struct hdr_histogram *h, int32_t index)
+{
+    int32_t bucket_index = (index >> h->sub_bucket_half_count_magnitude) - 1;
+    int32_t sub_bucket_index = (index & (h->sub_bucket_half_count - 1)) + h->sub_bucket_half_count;
+
+    if (bucket_index < 0) {
+        sub_bucket_index -= h->sub_bucket_half_count;
+        bucket_index = 0;
+    }
+
+    return ((int64_t) sub_bucket_index) << (bucket_index + h->unit_magnitude);
+}
+
+static int64_t size_of_equivalent_value_range(const struct hdr_histogram *h, int64_t value)
+{
+    int32_t bucket_index = get_bucket_index(h, value);
+    int32_t sub_bucket_index = get_sub_bucket_index(value, bucket_index, (int32_t) h->unit_magnitude);
+    int32_t adjusted_bucket = (sub_bucket_index >= h->sub_bucket_count) ? (bucket_index + 1) : bucket_index;
+    return INT64_C(1) << (h->unit_magnitude + adjusted_bucket);
+}
+
+static int64_t lowest_equivalent_value(const struct hdr_histogram *h, int64_t value)
+{
+    int32_t bucket_index = get_bucket_index(h, value);
+    int32_t sub_bucket_index = get_sub_bucket_index(value, bucket_index, (int32_t) h->unit_magnitude);
+    return ((int64_t) sub_bucket_index) << (bucket_index + h->unit_magnitude);
+}
+
+static int64_t highest_equivalent_value(const struct hdr_histogram *h, int64_t value)
+{
+    return lowest_equivalent_value(h, value) + size_of_equivalent_value_range(h, value) - 1;
+}
+
+static int64_t median_equivalent_value(const struct hdr_histogram *h, int64_t value)
+{
+    return lowest_equivalent_value(h, value) + (size_of_equivalent_value_range(h, value) >> 1);
+}
+
+/* recording */
+
+static bool record_values(struct hdr_histogram *h, int64_t value, int64_t count)
+{
+    int32_t index;
+
+    if (value < 0) {
+        return false;
+    }
+
+    index = counts_index_for(h, value);
+    if (index < 0 || h->counts_len <= index) {
+        return false;
+    }
+
+    h->counts[index] += count;
+    h->total_count += count;
+
+    if (value < h->min_value && value != 0) {
+        h->min_value = value;
+    }
+
+    if (value > h->max_value) {
+        h->max_value = value;
+    }
+
+    return true;
+}
+
+static bool record_corrected_values(struct hdr_histogram *h, int64_t value, int64_t count, int64_t expected_interval)
+{
+    int64_t missing_value;
+
+    if (!record_values(h, value, count)) {
+        return false;
+    }
+
+    if (expected_interval <= 0 || value <= expected_interval) {
+        return true;
+    }
+
+    for (missing_value = value - expected_interval; missing_value >= expected_interval; missing_value -= expected_interval) {
+        if (!record_values(h, missing_value, count)) {
+            return false;
+        }
+    }
+
+    return true;
+}
+
+/* queries, the counts are walked up to total_count as hdr_iter does */
+
+static int64_t value_at_percentile(const struct hdr_histogram *h, double percentile)
+{
+    double requested_percentile = percentile < 100.0 ? percentile : 100.0;
+    int64_t count_at_percentile = (int64_t) (((requested_percentile / 100) * h->total_count) + 0.5);
+    int64_t total = 0;
+    int32_t index;
+
+    count_at_percentile = count_at_percentile > 1 ? count_at_percentile : 1;
+
+    for (index = 0; index < h->counts_len; index++) {
+        total += h->counts[index];
+        if (total >= count_at_percentile) {
+            return highest_equivalent_value(h, value_at_index(h, index));
+        }
+    }
+
+    return 0;
+}
+
+static double mean(const struct hdr_histogram *h)
+{
+    int64_t total = 0;
+    int64_t count_to_index = 0;
+    int32_t index;
+
+    for (index = 0; index < h->counts_len && count_to_index < h->total_count; index++) {
+        int64_t count = h->counts[index];
+        count_to_index += count;
+        if (count != 0) {
+            total += count * median_equivalent_value(h, value_at_index(h, index));
+        }
+    }
+
+    return (total * 1.0) / h->total_count;
+}
+
+static double stddev(const struct hdr_histogram *h)
+{
+    double histogram_mean = mean(h);
+    double geometric_dev_total = 0.0;
+    int64_t count_to_index = 0;
+    int32_t index;
+
+    for (index = 0; index < h->counts_len && count_to_index < h->total_count; index++) {
+        int64_t count = h->counts[index];
+        count_to_index += count;
+        if (count != 0) {
+            double dev = (median_equivalent_value(h, value_at_index(h, index)) * 1.0) - histogram_mean;
+            geometric_dev_total += (dev * dev) * count;
+        }
+    }
+
+    return sqrt(geometric_dev_total / h->total_count);
+}
+
+/* Python functions */
+
+static bool parse_int64(PyObject *object, int64_t *value)
+{
+    long long result = PyLong_AsLongLong(object);
+
+    if (result == -1 && PyErr_Occurred()) {
+        return false;
+    }
+
+    *value = (int64_t) result;
+    return true;
+}
+
+static bool check_nargs(const char *name, Py_ssize_t nargs, Py_ssize_t expected)
+{
+    if (nargs != expected) {
+        PyErr_Format(PyExc_TypeError, "%s() takes exactly %zd arguments (%zd given)", name, expected, nargs);
+        return false;
+    }
+
+    return true;
+}
+
+static PyObject *py_record_value(PyObject *module, PyObject *const *args, Py_ssize_t nargs)
+{
+    struct hdr_histogram *h;
+    int64_t value;
+
+    if (!check_nargs("record_value", nargs, 2) || !(h = histogram_of(args[0])) || !parse_int64(args[1], &value)) {
+        return NULL;
+    }
+
+    return PyBool_FromLong(record_values(h, value, 1));
+}
+
+static PyObject *py_record_values(PyObject *module, PyObject *const *args, Py_ssize_t nargs)
+{
+    struct hdr_histogram *h;
+    int64_t value, count;
+
+    if (!check_nargs("record_values", nargs, 3) || !(h = histogram_of(args[0])) ||
+        !parse_int64(args[1], &value) || !parse_int64(args[2], &count)) {
+        return NULL;
+    }
+
+    return PyBool_FromLong(record_values(h, value, count));
+}
+
+static PyObject *py_record_corrected_value(PyObject *module, PyObject *const *args, Py_ssize_t nargs)
+{
+    struct hdr_histogram *h;
+    int64_t value, expected_interval;
+
+    if (!check_nargs("record_corrected_value", nargs, 3) || !(h = histogram_of(args[0])) ||
+        !parse_int64(args[1], &value) || !parse_int64(args[2], &expected_interval)) {
+        return NULL;
+    }
+
+    return PyBool_FromLong(record_corrected_values(h, value, 1, expected_interval));
+}
+
+/* record_many(handle, values[, expected_interval]), values is a buffer of
+ * int64, returns the number of values that could not be recorded */
+static PyObject *py_record_many(PyObject *module, PyObject *const *args, Py_ssize_t nargs)
+{
+    struct hdr_histogram *h;
+    int64_t expected_interval = 0;
+    Py_buffer view;
+    Py_ssize_t index, length;
+    int64_t dropped = 0;
+    const int64_t *values;
+
+    if (nargs != 2 && nargs != 3) {
+        PyErr_Format(PyExc_TypeError, "record_many() takes 2 or 3 arguments (%zd given)", nargs);
+        return NULL;
+    }
+
+    if (!(h = histogram_of(args[0])) || (nargs == 3 && !parse_int64(args[2], &expected_interval))) {
+        return NULL;
+    }
+
+    if (PyObject_GetBuffer(args[1], &view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0) {
+        return NULL;
+    }
+
+    if (view.itemsize != 8 || view.format == NULL || (strcmp(view.format, "q") && strcmp(view.format, "l") &&
+                                                      strcmp(view.format, "<q") && strcmp(view.format, "=q"))) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_TypeError, "values must be a buffer of int64");
+        return NULL;
+    }
+
+    values = (const int64_t *) view.buf;
+    length = view.len / 8;
+
+    Py_BEGIN_ALLOW_THREADS
+    for (index = 0; index < length; index++) {
+        if (!record_corrected_values(h, values[index], 1, expected_interval)) {
+            dropped++;
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&view);
+    return PyLong_FromLongLong(dropped);
+}
+
+static PyObject *py_value_at_percentile(PyObject *module, PyObject *const *args, Py_ssize_t nargs)
+{
+    struct hdr_histogram *h;
+    double percentile;
+    int64_t value;
+
+    if (!check_nargs("value_at_percentile", nargs, 2) || !(h = histogram_of(args[0]))) {
+        return NULL;
+    }
+
+    percentile = PyFloat_AsDouble(args[1]);
+    if (percentile == -1.0 && PyErr_Occurred()) {
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    value = value_at_percentile(h, percentile);
+    Py_END_ALLOW_THREADS
+
+    return PyLong_FromLongLong(value);
+}
+
+static PyObject *py_lowest_equivalent_value(PyObject *module, PyObject *const *args, Py_ssize_t nargs)
+{
+    struct hdr_histogram *h;
+    int64_t value;
+
+    if (!check_nargs("lowest_equivalent_value", nargs, 2) || !(h = histogram_of(args[0])) ||
+        !parse_int64(args[1], &value)) {
+        return NULL;
+    }
+
+    return PyLong_FromLongLong(lowest_equivalent_value(h, value));
+}
+
+static PyObject *py_min(PyObject *module, PyObject *handle)
+{
+    struct hdr_histogram *h = histogram_of(handle);
+
+    if (h == NULL) {
+        return NULL;
+    }
+
+    if (h->counts[0] > 0) {
+        return PyLong_FromLongLong(0);
+    }
+
+    if (h->min_value == INT64_MAX) {
+        return PyLong_FromLongLong(INT64_MAX);
+    }
+
+    return PyLong_FromLongLong(lowest_equivalent_value(h, h->min_value));
+}
+
+static PyObject *py_max(PyObject *module, PyObject *handle)
+{
+    struct hdr_histogram *h = histogram_of(handle);
+
+    if (h == NULL) {
+        return NULL;
+    }
+
+    if (h->max_value == 0) {
+        return PyLong_FromLongLong(0);
+    }
+
+    return PyLong_FromLongLong(highest_equivalent_value(h, h->max_value));
+}
+
+static PyObject *py_mean(PyObject *module, PyObject *handle)
+{
+    struct hdr_histogram *h = histogram_of(handle);
+    double result;
+
+    if (h == NULL) {
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    result = mean(h);
+    Py_END_ALLOW_THREADS
+
+    return PyFloat_FromDouble(result);
+}
+
+static PyObject *py_stddev(PyObject *module, PyObject *handle)
+{
+    struct hdr_histogram *h = histogram_of(handle);
+    double result;
+
+    if (h == NULL) {
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    result = stddev(h);
+    Py_END_ALLOW_THREADS
+
+    return PyFloat_FromDouble(result);
+}
+
+static PyMethodDef methods[] = {
+    {"record_value", (PyCFunction) (void (*)(void)) py_record_value, METH_FASTCALL, NULL},
+    {"record_values", (PyCFunction) (void (*)(void)) py_record_values, METH_FASTCALL, NULL},
+    {"record_corrected_value", (PyCFunction) (void (*)(void)) py_record_corrected_value, METH_FASTCALL, NULL},
+    {"record_many", (PyCFunction) (void (*)(void)) py_record_many, METH_FASTCALL, NULL},
+    {"value_at_percentile", (PyCFunction) (void (*)(void)) py_value_at_percentile, METH_FASTCALL, NULL},
+    {"lowest_equivalent_value", (PyCFunction) (void (*)(void)) py_lowest_equivalent_value, METH_FASTCALL, NULL},
+    {"min", py_min, METH_O, NULL},
+    {"max", py_max, METH_O, NULL},
+    {"mean", py_mean, METH_O, NULL},
+    {"stddev", py_stddev, METH_O, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT,
+    "_hdr",
+    "Native fast path for hdr.py",
+    -1,
+    methods,
+};
+
+PyMODINIT_FUNC PyInit__hdr(void)
+{
+    PyObject *m;
+
+    if (PyType_Ready(&HandleType) < 0) {
+        return NULL;
+    }
+
+    m = PyModule_Create(&module);
+    if (m == NULL) {
+        return NULL;
+    }
+
+    Py_INCREF(&HandleType);
+    if (PyModule_AddObject(m, "Handle", (PyObject *) &HandleType) < 0) {
+        Py_DECREF(&HandleType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    return m;
+}
@@ -1,10 +1,38 @@
 # -*- coding: utf8 -*-
-from collections import namedtuple
+from array import array
+import base64
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
 import ctypes
-from ctypes.util import find_library
-
-hdrlib = ctypes.cdll.LoadLibrary('libhdr_histogram.so')
-clib = ctypes.cdll.LoadLibrary(find_library('c'))
+import errno
+from itertools import accumulate, islice
+import math
+import mmap
+import os
+from struct import Struct
+import threading
+import time
+import weakref
+import zlib
+
+try:
+    # optional compiled extension, built from _hdr.c by setup.py
+    import _hdr
+except ImportError:
+    _hdr = None
+
+# The C library is loaded on first use, by load() or by the first
+# get_backend() call that may use it, so importing the module stays cheap.
+# HDR_HISTOGRAM_LIBRARY overrides the library searched by the loader.
+HDR_LIBRARY = 'libhdr_histogram.so'
+hdrlib = None
+clib = None
+# the reason the c backend is not available, once loading was attempted
+load_error = None
+
+# numpy is optional and imported by numpy_module() on first use
+numpy_cached = None
+numpy_checked = False
 
 cint = ctypes.c_int
 cbool = ctypes.c_bool
@@ -16,6 +44,77 @@ POINTER = ctypes.POINTER
 RangeCount = namedtuple('RangeValue', ('start', 'end', 'count'))
 Percentile = namedtuple('Percentile', ('percentile', 'value'))
 
+INT64_MAX = (1 << 63) - 1
+UINT64_MASK = (1 << 64) - 1
+
+# HdrHistogram V2 encoding, the cookies carry the word size (0x10) as the
+# Java and C implementations do
+V2_ENCODING_COOKIE_BASE = 0x1c849303
+V2_COMPRESSION_COOKIE_BASE = 0x1c849304
+V2_ENCODING_COOKIE = V2_ENCODING_COOKIE_BASE | 0x10
+V2_COMPRESSION_COOKIE = V2_COMPRESSION_COOKIE_BASE | 0x10
+
+# cookie, payload length, normalizing index offset, significant figures,
+# lowest trackable value, highest trackable value, conversion ratio
+ENCODING_HEADER = Struct('>iiiiqqd')
+# cookie, compressed length
+COMPRESSION_HEADER = Struct('>ii')
+
+# count width in bytes -> (ctypes type, memoryview format, largest count)
+COUNT_TYPES = {
+    2: (ctypes.c_int16, 'h', (1 << 15) - 1),
+    4: (ctypes.c_int32, 'i', (1 << 31) - 1),
+    8: (ctypes.c_int64, 'q', (1 << 63) - 1),
+}
+
+# cookie, size of the HistogramStruct that follows (native layout)
+MMAP_COOKIE = 0x1c8493e0
+MMAP_HEADER = Struct('=qq')
+
+
+def numpy_module():
+    # numpy when it is installed, None otherwise. It is imported on first use
+    # by the vectorized paths, it is slow to import.
+    global numpy_cached, numpy_checked
+
+    if not numpy_checked:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        numpy_cached = numpy
+        numpy_checked = True
+
+    return numpy_cached
+
+
+def int64_values(values):
+    # anything exposing a contiguous buffer of 8 byte signed integers
+    # (array('q'), memoryview, numpy int64 arrays) is used without copying,
+    # bytes and bytearray are reinterpreted as native int64 and everything
+    # else is converted value by value
+    if isinstance(values, (bytes, bytearray)):
+        return memoryview(values).cast('q')
+
+    try:
+        view = memoryview(values)
+    except TypeError:
+        return array('q', values)
+
+    fmt = view.format.lstrip('@=<')
+
+    if fmt in ('q', 'l') and view.itemsize == 8 and view.c_contiguous:
+        if fmt == 'q' and view.ndim == 1:
+            return view
+        return view.cast('B').cast('q')
+
+    numpy = numpy_module()
+    if numpy is not None and fmt in ('b', 'B', 'h', 'H', 'i', 'I', 'l', 'q'):
+        return numpy.ascontiguousarray(values, dtype=numpy.int64).reshape(-1)
+
+    return array('q', view.tolist())
+
 
 def function(library, name, arguments_types, return_type=None):
     func = getattr(library, name)
@@ -177,210 +276,3119 @@ IteratorStruct._fields_ = [
 ]
 
 
-# int hdr_init(int64_t, int64_t, int, struct hdr_histogram**);
-hdr_init = function(hdrlib, 'hdr_init', [int64, int64, cint, POINTER(HistogramPointer)], cint)
+# name -> (symbol, arguments types, return type), bound by load()
+HDR_FUNCTIONS = {
+    # int hdr_init(int64_t, int64_t, int, struct hdr_histogram**);
+    'hdr_init': ('hdr_init', [int64, int64, cint, POINTER(HistogramPointer)], cint),
+    # void hdr_reset(struct hdr_histogram*);
+    'hdr_reset': ('hdr_reset', [HistogramPointer], None),
+    # (we dont have a hdr_free)
+    # bool hdr_record_value(struct hdr_histogram*, int64_t);
+    'hdr_record_value': ('hdr_record_value', [HistogramPointer, int64], cbool),
+    # bool hdr_record_values(struct hdr_histogram*, int64_t, int64_t);
+    'hdr_record_value_repeat': ('hdr_record_values', [HistogramPointer, int64, int64], cbool),
+    # bool hdr_record_corrected_value(struct hdr_histogram*, int64_t, int64_t);
+    'hdr_record_corrected_value': ('hdr_record_corrected_value', [HistogramPointer, int64, int64], cbool),
+    # int64_t hdr_add(struct hdr_histogram*, struct hdr_histogram*);
+    'hdr_add': ('hdr_add', [HistogramPointer, HistogramPointer], int64),
+    # int64_t hdr_lowest_equivalent_value(struct hdr_histogram*, int64_t);
+    'hdr_lowest_equivalent_value': ('hdr_lowest_equivalent_value', [HistogramPointer, int64], int64),
+    # int64_t hdr_max(struct hdr_histogram*);
+    'hdr_max': ('hdr_max', [HistogramPointer], int64),
+    # double hdr_mean(struct hdr_histogram*);
+    'hdr_mean': ('hdr_mean', [HistogramPointer], cdouble),
+    # int64_t hdr_min(struct hdr_histogram*);
+    'hdr_min': ('hdr_min', [HistogramPointer], int64),
+    # double hdr_stddev(struct hdr_histogram*)
+    'hdr_stddev': ('hdr_stddev', [HistogramPointer], cdouble),
+    # int64_t hdr_value_at_percentile(struct hdr_histogram*, double);
+    'hdr_value_at_percentile': ('hdr_value_at_percentile', [HistogramPointer, cdouble], int64),
+    # void hdr_iter_init(struct hdr_iter*, struct hdr_histogram*);
+    'hdr_iter_init': ('hdr_iter_init', [POINTER(IteratorStruct), HistogramPointer], None),
+    # void hdr_iter_percentile_init(struct hdr_iter*, struct hdr_histogram*, int32_t);
+    'hdr_iter_percentile_init': ('hdr_iter_percentile_init', [POINTER(IteratorStruct), HistogramPointer, int32], None),
+    # void hdr_iter_recorded_init(struct hdr_iter*, struct hdr_histogram*);
+    'hdr_iter_recorded_init': ('hdr_iter_recorded_init', [POINTER(IteratorStruct), HistogramPointer], None),
+    # void hdr_iter_linear_init(struct hdr_iter*, struct hdr_histogram*, int64_t);
+    'hdr_iter_linear_init': ('hdr_iter_linear_init', [POINTER(IteratorStruct), HistogramPointer, int64], None),
+    # void hdr_iter_log_init( struct hdr_iter*, struct hdr_histogram*, int64_t, double);
+    'hdr_iter_log_init': ('hdr_iter_log_init', [POINTER(IteratorStruct), HistogramPointer, int64, cdouble], None),
+    # bool hdr_iter_next(struct hdr_iter*);
+    'hdr_iter_next': ('hdr_iter_next', [POINTER(IteratorStruct)], cbool),
+}
+
+
+class Library(object):
+    # the HDR_FUNCTIONS of the C library, as attributes set by load()
+    pass
 
-# void hdr_reset(struct hdr_histogram*);
-hdr_reset = function(hdrlib, 'hdr_reset', [HistogramPointer])
 
-# (we dont have a hdr_free)
+lib = Library()
 
-# bool hdr_record_value(struct hdr_histogram*, int64_t);
-hdr_record_value = function(hdrlib, 'hdr_record_value', [HistogramPointer, int64], cbool)
 
-# bool hdr_record_value(struct hdr_histogram*, int64_t);
-hdr_record_value_repeat = function(hdrlib, 'hdr_record_values', [HistogramPointer, int64], cbool)
+class HistogramIterator(object):
+    # Rows are produced chunk_size at a time by the fill() of each iteration
+    # type into a preallocated list, stepping only walks that list.
+    chunk_size = 256
 
-# bool hdr_record_corrected_value(struct hdr_histogram*, int64_t, int64_t);
-hdr_record_corrected_value = function(hdrlib, 'hdr_record_corrected_value', [HistogramPointer, int64, int64], cbool)
+    def __init__(self):
+        self.rows = [None] * self.chunk_size
+        self.position = self.chunk_size
+        self.filled = self.chunk_size
 
-# int64_t hdr_add(struct hdr_histogram*, struct hdr_histogram*);
-hdr_add = function(hdrlib, 'hdr_add', [HistogramPointer, HistogramPointer], int64)
+    def __iter__(self):
+        return self
 
-# int64_t hdr_lowest_equivalent_value(struct hdr_histogram*, int64_t);
-hdr_lowest_equivalent_value = function(hdrlib, 'hdr_lowest_equivalent_value', [HistogramPointer, int64], int64)
+    def __next__(self):
+        return self.next()
 
-# int64_t hdr_max(struct hdr_histogram*);
-hdr_max = function(hdrlib, 'hdr_max', [HistogramPointer], int64)
+    def next(self):
+        if self.position == self.filled:
+            if self.filled < self.chunk_size:
+                raise StopIteration()
 
-# double hdr_mean(struct hdr_histogram*);
-hdr_mean = function(hdrlib, 'hdr_mean', [HistogramPointer], cdouble)
+            self.filled = self.fill(self.rows)
+            self.position = 0
 
-# int64_t hdr_min(struct hdr_histogram*);
-hdr_min = function(hdrlib, 'hdr_min', [HistogramPointer], int64)
+            if self.filled == 0:
+                raise StopIteration()
 
-# double hdr_stddev(struct hdr_histogram*)
-hdr_stddev = function(hdrlib, 'hdr_stddev', [HistogramPointer], cdouble)
+        row = self.rows[self.position]
+        self.position += 1
+        return row
 
-# int64_t hdr_value_at_percentile(struct hdr_histogram*, double);
-hdr_value_at_percentile = function(hdrlib, 'hdr_value_at_percentile', [HistogramPointer, cdouble], int64)
+    def fill(self, rows):
+        raise NotImplementedError()
 
-# void hdr_iter_init(struct hdr_iter*, struct hdr_histogram*);
-hdr_iter_init = function(hdrlib, 'hdr_iter_init', [POINTER(IteratorStruct), HistogramPointer])
 
-# void hdr_iter_percentile_init(struct hdr_iter*, struct hdr_histogram*, int32_t);
-hdr_iter_percentile_init = function(
-    hdrlib,
-    'hdr_iter_percentile_init',
-    [POINTER(IteratorStruct), HistogramPointer, int32]
-)
+class CHistogramIterator(HistogramIterator):
+    def __init__(self, histogramref):
+        super(CHistogramIterator, self).__init__()
+        self.iterator = IteratorStruct()
+        self.iteratorref = ctypes.byref(self.iterator)
+        self.histogramref = histogramref
 
-# void hdr_iter_recorded_init(struct hdr_iter*, struct hdr_histogram*);
-hdr_iter_recorded_init = function(hdrlib, 'hdr_iter_recorded_init', [POINTER(IteratorStruct), HistogramPointer])
 
-# void hdr_iter_linear_init(struct hdr_iter*, struct hdr_histogram*, int64_t);
-hdr_iter_linear_init = function(hdrlib, 'hdr_iter_linear_init', [POINTER(IteratorStruct), HistogramPointer, int64])
+class CBasicIterator(CHistogramIterator):
+    def __init__(self, histogramref):
+        super(CBasicIterator, self).__init__(histogramref)
+        lib.hdr_iter_init(self.iteratorref, self.histogramref)
 
-# void hdr_iter_log_init( struct hdr_iter*, struct hdr_histogram*, int64_t, double);
-hdr_iter_log_init = function(hdrlib, 'hdr_iter_log_init', [POINTER(IteratorStruct), HistogramPointer, int64, cdouble])
+    def fill(self, rows):
+        iterator = self.iterator
+        iteratorref = self.iteratorref
 
-# bool hdr_iter_next(struct hdr_iter*);
-hdr_iter_next = function(hdrlib, 'hdr_iter_next', [POINTER(IteratorStruct)], cbool)
+        for position in range(len(rows)):
+            if not lib.hdr_iter_next(iteratorref):
+                return position
 
+            rows[position] = RangeCount(
+                iterator.value_from_index,
+                iterator.highest_equivalent_value,
+                iterator.count_at_index,
+            )
 
-class HistogramIterator(object):
-    def __init__(self, histogramref, itertype='basic', units_per_bucket=None):
-        self.iterator = IteratorStruct()
-        self.iteratorref = ctypes.byref(self.iterator)
-        self.histogramref = histogramref
-        self.itertype = itertype
-
-        if self.itertype == 'basic':
-            hdr_iter_init(self.iteratorref, self.histogramref)
-        elif self.itertype == 'recorded':
-            hdr_iter_recorded_init(self.iteratorref, self.histogramref)
-        elif self.itertype == 'linear':
-            if units_per_bucket is None:
-                raise Exception('The linear iterator must have units_per_bucket specified')
-            hdr_iter_linear_init(self.iteratorref, self.histogramref, int64(units_per_bucket))
-        else:
-            raise NotImplemented()
-        # elif itertype == 'percentile':
-        #     hdr_iter_percentile_init(self.iterator, self.histogramref)
-        # elif itertype == 'log':
-        #     hdr_iter_log_init(self.iterator, self.histogramref)
+        return len(rows)
 
-    def __iter__(self):
-        return self
 
-    def __next__(self):
-        return self.next()
+class CRecordedIterator(CBasicIterator):
+    def __init__(self, histogramref):
+        CHistogramIterator.__init__(self, histogramref)
+        lib.hdr_iter_recorded_init(self.iteratorref, self.histogramref)
 
-    def next(self):
-        if not hdr_iter_next(self.iteratorref):
-            raise StopIteration()
-
-        if self.itertype == 'basic':
-            return RangeCount(
-                self.iterator.value_from_index,
-                self.iterator.highest_equivalent_value,
-                self.iterator.count_at_index,
-            )
-        if self.itertype == 'recorded':
-            return RangeCount(
-                self.iterator.value_from_index,
-                self.iterator.highest_equivalent_value,
-                # self.iterator.specifis.recorded.count_added_in_this_iteration_step,
-                self.iterator.count_at_index,
-            )
-        if self.itertype == 'linear':
-            return RangeCount(
-                self.iterator.value_from_index,
-                self.iterator.highest_equivalent_value,
-                self.iterator.specifics.linear.count_added_in_this_iteration_step,
-            )
-        elif self.itertype == 'percentile':
-            return Percentile(
-                self.iterator.specifics.percentile.percentile,
-                self.iterator.highest_equivalent_value,
+
+class CLinearIterator(CHistogramIterator):
+    def __init__(self, histogramref, units_per_bucket):
+        super(CLinearIterator, self).__init__(histogramref)
+        lib.hdr_iter_linear_init(self.iteratorref, self.histogramref, int64(units_per_bucket))
+        self.specifics = self.iterator.specifics.linear
+
+    def fill(self, rows):
+        iterator = self.iterator
+        iteratorref = self.iteratorref
+        specifics = self.specifics
+
+        for position in range(len(rows)):
+            if not lib.hdr_iter_next(iteratorref):
+                return position
+
+            rows[position] = RangeCount(
+                iterator.value_from_index,
+                iterator.highest_equivalent_value,
+                specifics.count_added_in_this_iteration_step,
             )
 
-        raise NotImplemented()
+        return len(rows)
 
 
-class Histogram(object):
-    def __init__(self, lowest, highest, significant):
-        self.lowest = lowest
-        self.highest = highest
-        self.significant = significant
-        self.histogram = histogram = POINTER(HistogramStruct)()
+class CLogIterator(CLinearIterator):
+    def __init__(self, histogramref, value_units_first_bucket, log_base):
+        CHistogramIterator.__init__(self, histogramref)
+        lib.hdr_iter_log_init(self.iteratorref, self.histogramref, int64(value_units_first_bucket), cdouble(log_base))
+        self.specifics = self.iterator.specifics.log
 
-        if lowest < 1:
-            raise Exception('lowest must be larger than 1')
 
-        if lowest * 2 > highest:
-            raise Exception('lowest cannot be larger than highest/2')
+class CPercentileIterator(CHistogramIterator):
+    def __init__(self, histogramref, ticks_per_half_distance):
+        super(CPercentileIterator, self).__init__(histogramref)
+        lib.hdr_iter_percentile_init(self.iteratorref, self.histogramref, int32(ticks_per_half_distance))
+        self.specifics = self.iterator.specifics.percentiles
 
-        if not (1 < significant < 6):
-            raise Exception('significant must be between 1 and 6 (non inclusive)')
+    def fill(self, rows):
+        iterator = self.iterator
+        iteratorref = self.iteratorref
+        specifics = self.specifics
+
+        for position in range(len(rows)):
+            if not lib.hdr_iter_next(iteratorref):
+                return position
+
+            rows[position] = Percentile(specifics.percentile, iterator.highest_equivalent_value)
+
+        return len(rows)
+
+
+def buckets_needed_to_cover_value(value, sub_bucket_count, unit_magnitude):
+    smallest_untrackable_value = sub_bucket_count << unit_magnitude
+    buckets_needed = 1
+
+    while smallest_untrackable_value <= value:
+        if smallest_untrackable_value > INT64_MAX // 2:
+            return buckets_needed + 1
+
+        smallest_untrackable_value <<= 1
+        buckets_needed += 1
+
+    return buckets_needed
+
+
+def bucket_config(struct, lowest, highest, significant):
+    # port of hdr_calculate_bucket_config() and hdr_init_preallocated(), the
+    # floating point math is kept as is so the layouts are always the same
+    if lowest < 1 or significant < 1 or 5 < significant:
+        return errno.EINVAL
+
+    if lowest * 2 > highest:
+        return errno.EINVAL
+
+    largest_value_with_single_unit_resolution = 2 * 10 ** significant
+    sub_bucket_count_magnitude = int(math.ceil(math.log(largest_value_with_single_unit_resolution) / math.log(2)))
+    sub_bucket_half_count_magnitude = max(sub_bucket_count_magnitude, 1) - 1
+    unit_magnitude = int(math.floor(math.log(lowest) / math.log(2)))
+    sub_bucket_count = 2 ** (sub_bucket_half_count_magnitude + 1)
+
+    if unit_magnitude + sub_bucket_half_count_magnitude > 61:
+        return errno.EINVAL
+
+    bucket_count = buckets_needed_to_cover_value(highest, sub_bucket_count, unit_magnitude)
+
+    struct.lowest_trackable_value = lowest
+    struct.highest_trackable_value = highest
+    struct.unit_magnitude = unit_magnitude
+    struct.significant_figures = significant
+    struct.sub_bucket_half_count_magnitude = sub_bucket_half_count_magnitude
+    struct.sub_bucket_half_count = sub_bucket_count // 2
+    struct.sub_bucket_mask = (sub_bucket_count - 1) << unit_magnitude
+    struct.sub_bucket_count = sub_bucket_count
+    struct.bucket_count = bucket_count
+    struct.min_value = INT64_MAX
+    struct.max_value = 0
+    struct.normalizing_index_offset = 0
+    struct.conversion_ratio = 1.0
+    struct.counts_len = (bucket_count + 1) * (sub_bucket_count // 2)
+    struct.total_count = 0
+
+    return 0
+
+
+# The bucket math below works with anything exposing the HistogramStruct
+# layout fields (the ctypes structure itself or a PythonHistogram)
+
+def get_bucket_index(h, value):
+    # the bit_length is the smallest power of 2 containing the value
+    return (value | h.sub_bucket_mask).bit_length() - h.unit_magnitude - (h.sub_bucket_half_count_magnitude + 1)
+
+
+def counts_index_for(h, value):
+    bucket_index = get_bucket_index(h, value)
+    sub_bucket_index = value >> (bucket_index + h.unit_magnitude)
+    bucket_base_index = (bucket_index + 1) << h.sub_bucket_half_count_magnitude
+    return bucket_base_index + sub_bucket_index - h.sub_bucket_half_count
+
+
+def value_at_index(h, index):
+    bucket_index = (index >> h.sub_bucket_half_count_magnitude) - 1
+    sub_bucket_index = (index & (h.sub_bucket_half_count - 1)) + h.sub_bucket_half_count
+
+    if bucket_index < 0:
+        sub_bucket_index -= h.sub_bucket_half_count
+        bucket_index = 0
+
+    return sub_bucket_index << (bucket_index + h.unit_magnitude)
+
+
+def size_of_equivalent_value_range(h, value):
+    bucket_index = get_bucket_index(h, value)
+    sub_bucket_index = value >> (bucket_index + h.unit_magnitude)
+
+    if sub_bucket_index >= h.sub_bucket_count:
+        bucket_index += 1
+
+    return 1 << (h.unit_magnitude + bucket_index)
+
+
+def lowest_equivalent_value(h, value):
+    bucket_index = get_bucket_index(h, value)
+    sub_bucket_index = value >> (bucket_index + h.unit_magnitude)
+    return sub_bucket_index << (bucket_index + h.unit_magnitude)
+
+
+def highest_equivalent_value(h, value):
+    return lowest_equivalent_value(h, value) + size_of_equivalent_value_range(h, value) - 1
+
+
+def median_equivalent_value(h, value):
+    return lowest_equivalent_value(h, value) + (size_of_equivalent_value_range(h, value) >> 1)
+
+
+def index_values(h, length):
+    # vectorized value_at_index() for the indexes [0, length)
+    numpy = numpy_module()
+    index = numpy.arange(length, dtype=numpy.int64)
+    bucket_index = (index >> h.sub_bucket_half_count_magnitude) - 1
+    sub_bucket_index = (index & (h.sub_bucket_half_count - 1)) + h.sub_bucket_half_count
+
+    first_bucket = bucket_index < 0
+    sub_bucket_index[first_bucket] -= h.sub_bucket_half_count
+    bucket_index[first_bucket] = 0
+
+    return sub_bucket_index << (bucket_index + h.unit_magnitude)
+
+
+def bucket_indexes(h, values):
+    # vectorized get_bucket_index(), the values must not be negative
+    numpy = numpy_module()
+    shift = h.unit_magnitude + h.sub_bucket_half_count_magnitude + 1
+    powers = numpy.array([1 << bit for bit in range(shift, 63)], dtype=numpy.int64)
+    return numpy.searchsorted(powers, values | h.sub_bucket_mask, side='right')
+
+
+def counts_indexes_for(h, values):
+    # vectorized counts_index_for(), the values must not be negative
+    bucket_index = bucket_indexes(h, values)
+    sub_bucket_index = values >> (bucket_index + h.unit_magnitude)
+    bucket_base_index = (bucket_index + 1) << h.sub_bucket_half_count_magnitude
+    return bucket_base_index + sub_bucket_index - h.sub_bucket_half_count
+
+
+def lowest_equivalent_values(h, values):
+    shift = bucket_indexes(h, values) + h.unit_magnitude
+    return (values >> shift) << shift
+
+
+def same_layout(a, b):
+    return (
+        a.counts_len == b.counts_len and
+        a.unit_magnitude == b.unit_magnitude and
+        a.sub_bucket_half_count_magnitude == b.sub_bucket_half_count_magnitude
+    )
+
+
+def values_at_percentiles(h, counts, total_count, percentiles):
+    # hdr_value_at_percentile() for several percentiles with a single pass
+    # over the counts, the results are in the same order as the percentiles
+    numpy = numpy_module()
+
+    if total_count == 0:
+        return [0] * len(percentiles)
+
+    targets = [
+        max(int(((min(percentile, 100.0) / 100) * total_count) + 0.5), 1)
+        for percentile in percentiles
+    ]
+    indexes = [None] * len(targets)
+
+    if numpy is not None:
+        cumulative = numpy.cumsum(numpy.asarray(counts, dtype=numpy.int64))
+        found = numpy.searchsorted(cumulative, targets, side='left').tolist()
+        for position, index in enumerate(found):
+            if index < len(cumulative):
+                indexes[position] = index
+    else:
+        order = sorted(range(len(targets)), key=targets.__getitem__)
+        position = 0
+        total = 0
+        for index in range(len(counts)):
+            total += counts[index]
+            while position < len(order) and total >= targets[order[position]]:
+                indexes[order[position]] = index
+                position += 1
+            if position == len(order):
+                break
+
+    return [
+        0 if index is None else highest_equivalent_value(h, value_at_index(h, index))
+        for index in indexes
+    ]
+
+
+def missing_counts(h, values, weights, interval, length):
+    # Per counts index, the values hdr_record_corrected_value() adds below
+    # each of the values: value - interval down to interval. weights are the
+    # times each value was recorded, None for once. The values with fewer
+    # missing values than length generate them in chunks, the others are
+    # counted per bucket.
+    numpy = numpy_module()
+    counts = numpy.zeros(length, dtype=numpy.int64)
+    values = numpy.asarray(values, dtype=numpy.int64)
+    if weights is None:
+        weights = numpy.ones(len(values), dtype=numpy.int64)
+    else:
+        weights = numpy.asarray(weights, dtype=numpy.int64)
+
+    # the missing values are remainder + m * interval for m in 1..quotient-1
+    quotients = values // interval
+    remainders = values - quotients * interval
+    sizes = numpy.maximum(quotients - 1, 0)
+
+    generated = (sizes > 0) & (sizes <= length)
+    sizes_generated = sizes[generated]
+    remainders_generated = remainders[generated]
+    weights_generated = weights[generated]
+    ends = numpy.cumsum(sizes_generated)
+    start = 0
+
+    while start < len(ends):
+        limit = ends[start] - sizes_generated[start] + (1 << 20)
+        stop = max(int(numpy.searchsorted(ends, limit, side='right')), start + 1)
+        chunk = sizes_generated[start:stop]
+        offsets = numpy.cumsum(chunk) - chunk
+        multiples = numpy.arange(int(chunk.sum())) - numpy.repeat(offsets, chunk) + 1
+        missing = numpy.repeat(remainders_generated[start:stop], chunk) + multiples * interval
+        numpy.add.at(counts, counts_indexes_for(h, missing), numpy.repeat(weights_generated[start:stop], chunk))
+        start = stop
+
+    # the number of missing values up to x is clip((x - remainder) // interval, 0, quotient - 1)
+    bounds = index_values(h, length + 1)
+    lowest = bounds[:-1] - 1
+    highest = bounds[1:] - 1
+
+    counted = sizes > length
+    for quotient, remainder, weight in zip(quotients[counted], remainders[counted], weights[counted]):
+        up_to_highest = numpy.clip((highest - remainder) // interval, 0, quotient - 1)
+        up_to_lowest = numpy.clip((lowest - remainder) // interval, 0, quotient - 1)
+        counts += (up_to_highest - up_to_lowest) * weight
+
+    return counts
+
+
+def record_array(h, struct, counts, values, interval, fit=None):
+    # vectorized record_many(), with the values added by
+    # record_corrected_value() when interval is positive. counts returns the
+    # numpy view of the counts, fit widens them ahead of an overflow when they
+    # are narrower than 8 bytes.
+    numpy = numpy_module()
+    values = numpy.frombuffer(values, dtype=numpy.int64) if len(values) else numpy.zeros(0, numpy.int64)
+    received = len(values)
+    values = values[values >= 0]
+    indexes = counts_indexes_for(h, values)
+    tracked = indexes < h.counts_len
+    values = values[tracked]
+    indexes = indexes[tracked]
+    dropped = received - len(values)
+
+    if not len(values):
+        return dropped
+
+    total = len(values)
+    smallest = values[values != 0]
+
+    if interval > 0:
+        added = numpy.bincount(indexes, minlength=h.counts_len)
+        missing = missing_counts(h, values, None, interval, h.counts_len)
+        added += missing
+        total += int(missing.sum())
+
+        # the smallest missing value of each value is its remainder plus the
+        # interval
+        corrected = values[values // interval >= 2]
+        smallest = numpy.concatenate((smallest, corrected % interval + interval))
+    elif fit is None:
+        added = None
+        numpy.add.at(counts(), indexes, 1)
+    else:
+        added = numpy.bincount(indexes, minlength=h.counts_len)
+
+    if added is not None:
+        if fit is not None:
+            fit(int((counts() + added).max()))
+        counts()[:] += added
+
+    struct.total_count += total
+
+    if len(smallest):
+        struct.min_value = min(struct.min_value, int(smallest.min()))
+    struct.max_value = max(struct.max_value, int(values.max()))
+
+    return dropped
+
+
+def reset_internal_counters(h, counts):
+    # port of hdr_reset_internal_counters(), recomputes total_count, min_value
+    # and max_value from the counts
+    numpy = numpy_module()
+    min_non_zero_index = -1
+    max_index = -1
+
+    if numpy is not None:
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        non_zero = numpy.flatnonzero(counts > 0)
+        total_count = int(counts[non_zero].sum())
+
+        if len(non_zero):
+            max_index = int(non_zero[-1])
+            min_non_zero_index = int(non_zero[1] if non_zero[0] == 0 and len(non_zero) > 1 else non_zero[0])
+            if min_non_zero_index == 0:
+                min_non_zero_index = -1
+    else:
+        total_count = 0
+        for index in range(len(counts)):
+            count = counts[index]
+            if count > 0:
+                total_count += count
+                max_index = index
+                if min_non_zero_index == -1 and index != 0:
+                    min_non_zero_index = index
+
+    if max_index == -1:
+        h.max_value = 0
+    else:
+        h.max_value = highest_equivalent_value(h, value_at_index(h, max_index))
+
+    if min_non_zero_index == -1:
+        h.min_value = INT64_MAX
+    else:
+        h.min_value = value_at_index(h, min_non_zero_index)
+
+    h.total_count = total_count
+
+
+def subtract_counts(counts, other_counts):
+    # counts -= other_counts, the total, min and max are then rebuilt by
+    # reset_internal_counters()
+    numpy = numpy_module()
+
+    if numpy is not None:
+        counts = numpy.asarray(counts)
+        counts -= numpy.asarray(other_counts)
+        return
+
+    for index in range(len(other_counts)):
+        count = other_counts[index]
+        if count:
+            counts[index] -= count
+
+
+def zigzag_encode_counts(counts, length):
+    # ZigZag LEB128 encoding of the first length counts, a run of zeros is
+    # written as its negated length. As in the Java implementation the 9th
+    # byte of a value carries 8 bits.
+    numpy = numpy_module()
+
+    if length == 0:
+        return b''
+
+    if numpy is not None:
+        counts = numpy.asarray(counts, dtype=numpy.int64)[:length]
+        non_zero = numpy.flatnonzero(counts)
+        gaps = numpy.diff(non_zero, prepend=-1) - 1
+        tokens = numpy.stack((numpy.where(gaps == 1, 0, -gaps), counts[non_zero]), axis=1).ravel()
+        tokens = tokens[numpy.stack((gaps > 0, numpy.ones(len(gaps), dtype=bool)), axis=1).ravel()]
+
+        zigzag = ((tokens << 1) ^ (tokens >> 63)).view(numpy.uint64)
+        sizes = numpy.ones(len(zigzag), dtype=numpy.int64)
+        for byte in range(1, 9):
+            sizes += zigzag >= numpy.uint64(1 << (7 * byte))
+
+        offsets = numpy.cumsum(sizes) - sizes
+        encoded = numpy.zeros(int(sizes.sum()), dtype=numpy.uint8)
+        for byte in range(9):
+            selected = sizes > byte
+            values = zigzag[selected] >> numpy.uint64(7 * byte)
+            if byte < 8:
+                continued = numpy.where(sizes[selected] > byte + 1, numpy.uint64(0x80), numpy.uint64(0))
+                values = (values & numpy.uint64(0x7f)) | continued
+            encoded[offsets[selected] + byte] = values
+
+        return encoded.tobytes()
+
+    encoded = bytearray()
+    index = 0
+    while index < length:
+        count = counts[index]
+        index += 1
+
+        if count == 0:
+            zeros = 1
+            while index < length and counts[index] == 0:
+                zeros += 1
+                index += 1
+            if zeros > 1:
+                count = -zeros
+
+        value = ((count << 1) ^ (count >> 63)) & UINT64_MASK
+        for _ in range(8):
+            if value < 0x80:
+                break
+            encoded.append((value & 0x7f) | 0x80)
+            value >>= 7
+        encoded.append(value)
+
+    return bytes(encoded)
+
+
+def zigzag_decode_counts(payload, counts):
+    # writes the counts encoded by zigzag_encode_counts() into counts
+    numpy = numpy_module()
+
+    if not len(payload):
+        return
+
+    if numpy is not None:
+        data = numpy.frombuffer(payload, dtype=numpy.uint8)
+        ends = numpy.flatnonzero(data < 0x80)
+
+        # 9 byte values are rare enough to be left to the loop below
+        if len(ends) and ends[-1] == len(data) - 1 and numpy.diff(ends, prepend=-1).max() <= 8:
+            starts = numpy.concatenate(([0], ends[:-1] + 1))
+            shifts = (numpy.arange(len(data)) - numpy.repeat(starts, ends - starts + 1)) * 7
+            values = numpy.add.reduceat((data & 0x7f).astype(numpy.uint64) << shifts.astype(numpy.uint64), starts)
+            tokens = (values >> numpy.uint64(1)).astype(numpy.int64) ^ -(values & numpy.uint64(1)).astype(numpy.int64)
+
+            advance = numpy.where(tokens < 0, -tokens, 1)
+            positions = numpy.cumsum(advance) - advance
+            if positions[-1] + advance[-1] > len(counts):
+                raise Exception('the encoded counts do not fit the histogram')
+
+            recorded = tokens >= 0
+            numpy.frombuffer(counts, dtype=numpy.int64)[positions[recorded]] = tokens[recorded]
+            return
+
+    index = 0
+    position = 0
+    while position < len(payload):
+        value = 0
+        for shift in range(0, 56, 7):
+            byte = payload[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+        else:
+            value |= payload[position] << 56
+            position += 1
+
+        value = (value >> 1) ^ -(value & 1)
+
+        if value < 0:
+            index -= value
+        else:
+            if index >= len(counts):
+                raise Exception('the encoded counts do not fit the histogram')
+            counts[index] = value
+            index += 1
+
+    if index > len(counts):
+        raise Exception('the encoded counts do not fit the histogram')
+
+
+def unpack_encoded(encoded):
+    # the layout, conversion ratio and zigzag_encode_counts() payload of a
+    # Histogram.encode() result
+    data = base64.b64decode(encoded)
+
+    cookie, length = COMPRESSION_HEADER.unpack_from(data)
+    if cookie & ~0xf0 != V2_COMPRESSION_COOKIE_BASE:
+        raise Exception('invalid compression cookie {:#x}'.format(cookie))
+
+    data = zlib.decompress(data[COMPRESSION_HEADER.size:COMPRESSION_HEADER.size + length])
+
+    cookie, length, _, significant, lowest, highest, conversion_ratio = ENCODING_HEADER.unpack_from(data)
+    if cookie & ~0xf0 != V2_ENCODING_COOKIE_BASE:
+        raise Exception('invalid encoding cookie {:#x}'.format(cookie))
+
+    payload = memoryview(data)[ENCODING_HEADER.size:ENCODING_HEADER.size + length]
+    return lowest, highest, significant, conversion_ratio, payload
+
+
+def next_percentile_to_iterate_to(percentile, ticks_per_half_distance):
+    # the reporting ticks get denser as the percentiles approach 100
+    temp = int(math.log(100 / (100.0 - percentile)) / math.log(2)) + 1
+    half_distance = int(math.pow(2, temp))
+    return percentile + 100.0 / (ticks_per_half_distance * half_distance)
+
+
+def iteration_parameters(itertype, units_per_bucket, value_units_first_bucket, log_base, ticks_per_half_distance):
+    if itertype not in ('basic', 'recorded', 'linear', 'log', 'percentile'):
+        raise Exception('unknown iteration type {}'.format(itertype))
+
+    if itertype == 'linear' and units_per_bucket is None:
+        raise Exception('The linear iterator must have units_per_bucket specified')
+
+    if itertype == 'log' and (value_units_first_bucket is None or log_base is None):
+        raise Exception('The log iterator must have value_units_first_bucket and log_base specified')
+
+    if itertype == 'log' and int(log_base) < 2:
+        raise Exception('log_base must be at least 2')
+
+    if itertype == 'percentile' and ticks_per_half_distance is None:
+        raise Exception('The percentile iterator must have ticks_per_half_distance specified')
+
+
+def iterate_all(h, counts, total_count):
+    # Ports of the hdr_iter_* iterations over a counts buffer, the
+    # bucket_index/sub_bucket_index pair is replaced by the flat counts index
+    # they map to. Yields (value_from_index, highest_equivalent_value, count)
+    # tuples, or (percentile, highest_equivalent_value) for the percentiles.
+    count_to_index = 0
+
+    for index in range(len(counts)):
+        if count_to_index >= total_count:
+            return
+
+        count = counts[index]
+        count_to_index += count
+        yield RangeCount(value_at_index(h, index), value_at_index(h, index + 1) - 1, count)
+
+
+def iterate_recorded(h, counts, total_count):
+    count_to_index = 0
+
+    for index in range(len(counts)):
+        if count_to_index >= total_count:
+            return
+
+        count = counts[index]
+        if count:
+            count_to_index += count
+            yield RangeCount(value_at_index(h, index), value_at_index(h, index + 1) - 1, count)
+
+
+def linear_levels(units_per_bucket):
+    level = units_per_bucket
+    while True:
+        yield level
+        level += units_per_bucket
+
+
+def log_levels(value_units_first_bucket, log_base):
+    level = value_units_first_bucket
+    log_base = int(log_base)
+    while True:
+        yield level
+        level *= log_base
+
+
+def iterate_levels(h, counts, total_count, levels):
+    # the linear and log iterations, each step reports the counts up to the
+    # next reporting level
+    length = len(counts)
+    index = -1
+    value = 0
+    count_to_index = 0
+
+    for level in levels:
+        level_lowest_equivalent = lowest_equivalent_value(h, level)
+
+        if count_to_index >= total_count and value_at_index(h, index + 1) <= level_lowest_equivalent:
+            return
+
+        added = 0
+
+        while value < level_lowest_equivalent:
+            index += 1
+            if index >= length:
+                return
+
+            count = counts[index]
+            count_to_index += count
+            added += count
+            value = value_at_index(h, index)
+
+        yield RangeCount(value, value_at_index(h, index + 1) - 1 if index >= 0 else 0, added)
+
+
+def iterate_percentiles(h, counts, total_count, ticks_per_half_distance):
+    length = len(counts)
+    index = -1
+    count_to_index = 0
+    percentile_to_iterate_to = 0.0
+
+    while count_to_index < total_count:
+        index += 1
+        if index >= length:
+            return
+
+        count_at_index = counts[index]
+        count_to_index += count_at_index
+
+        while count_at_index != 0 and percentile_to_iterate_to <= (100.0 * count_to_index) / total_count:
+            yield Percentile(percentile_to_iterate_to, value_at_index(h, index + 1) - 1)
+
+            if count_to_index >= total_count:
+                break
+
+            percentile_to_iterate_to = next_percentile_to_iterate_to(percentile_to_iterate_to, ticks_per_half_distance)
+
+    yield Percentile(100.0, value_at_index(h, index + 1) - 1 if index >= 0 else 0)
+
+
+def iterate_counts(h, counts, total_count, itertype, units_per_bucket=None, value_units_first_bucket=None,
+                   log_base=None, ticks_per_half_distance=None):
+    if itertype == 'basic':
+        return iterate_all(h, counts, total_count)
+
+    if itertype == 'recorded':
+        return iterate_recorded(h, counts, total_count)
+
+    if itertype == 'linear':
+        return iterate_levels(h, counts, total_count, linear_levels(units_per_bucket))
+
+    if itertype == 'log':
+        return iterate_levels(h, counts, total_count, log_levels(value_units_first_bucket, log_base))
+
+    return iterate_percentiles(h, counts, total_count, ticks_per_half_distance)
+
+
+def iteration_arrays(h, counts, total_count, itertype, units_per_bucket=None, value_units_first_bucket=None,
+                     log_base=None, ticks_per_half_distance=None):
+    # vectorized iterate_counts(), returns the columns as numpy arrays
+    numpy = numpy_module()
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    length = len(counts)
+    values = index_values(h, length + 1)
+    cumulative = numpy.concatenate(([0], numpy.cumsum(counts)))
+
+    # the iterations stop once total_count is reached
+    last = min(int(numpy.searchsorted(cumulative[1:], total_count, side='left')), length - 1) if total_count > 0 else -1
+
+    if itertype in ('basic', 'recorded'):
+        indexes = numpy.arange(last + 1)
+        if itertype == 'recorded':
+            indexes = indexes[counts[:last + 1] != 0]
+        return RangeCount(values[indexes], values[indexes + 1] - 1, counts[indexes])
+
+    if itertype in ('linear', 'log'):
+        # the levels are generated past the bucket after the last one, the
+        # iteration may step into it when the last index is 0
+        limit = int(values[min(last + 2, length)])
+        if itertype == 'linear':
+            generator = linear_levels(units_per_bucket)
+        else:
+            generator = log_levels(value_units_first_bucket, log_base)
+
+        levels = []
+        for level in generator:
+            levels.append(level)
+            if level > limit:
+                break
+
+        levels = numpy.array([min(level, INT64_MAX) for level in levels], dtype=numpy.int64)
+        lowest = lowest_equivalent_values(h, levels)
+
+        # each step ends at the first index reaching its reporting level, the
+        # value_from_index of the initial state (index -1) is 0
+        found = numpy.searchsorted(values[:length], lowest, side='left')
+        indexes = numpy.where(lowest <= 0, -1, found)
+        previous = numpy.concatenate(([-1], indexes[:-1]))
+
+        proceed = (cumulative[previous + 1] < total_count) | (values[previous + 1] > lowest)
+        proceed &= (lowest <= 0) | (found < length)
+        steps = int(numpy.argmin(proceed)) if not proceed.all() else len(proceed)
+        indexes = indexes[:steps]
+        previous = previous[:steps]
+
+        initial = indexes < 0
+        return RangeCount(
+            numpy.where(initial, 0, values[indexes]),
+            numpy.where(initial, 0, values[indexes + 1] - 1),
+            cumulative[indexes + 1] - cumulative[previous + 1],
+        )
+
+    if last < 0:
+        return Percentile(numpy.array([100.0]), numpy.zeros(1, dtype=numpy.int64))
+
+    non_zero = numpy.flatnonzero(counts[:last + 1])
+    reached = (100.0 * cumulative[non_zero + 1]) / total_count
+
+    # the percentiles are generated up to the first one found at the last
+    # non empty bucket, then 100 closes the iteration
+    threshold = reached[-2] if len(non_zero) > 1 else -1.0
+    percentiles = [0.0]
+    while percentiles[-1] <= threshold:
+        percentiles.append(next_percentile_to_iterate_to(percentiles[-1], ticks_per_half_distance))
+    percentiles.append(100.0)
+
+    positions = numpy.searchsorted(reached, percentiles[:-1], side='left')
+    indexes = numpy.concatenate((non_zero[positions], [non_zero[-1]]))
+    return Percentile(numpy.array(percentiles), values[indexes + 1] - 1)
+
+
+class PythonHistogram(object):
+    # The pure python counterpart of the hdr_histogram allocated by hdr_init,
+    # the header lives in a HistogramStruct and the counts in a separate int64
+    # buffer, so both backends share the same memory layout. The counts may
+    # also be 2 or 4 bytes wide, the struct's counts pointer then has the
+    # address of the narrower buffer.
+    def __init__(self, struct, buffer):
+        self.struct = struct
+        self.use(buffer)
+
+        # immutable after initialization, cached to avoid the ctypes lookups
+        self.unit_magnitude = struct.unit_magnitude
+        self.sub_bucket_half_count_magnitude = struct.sub_bucket_half_count_magnitude
+        self.sub_bucket_half_count = struct.sub_bucket_half_count
+        self.sub_bucket_mask = struct.sub_bucket_mask
+        self.sub_bucket_count = struct.sub_bucket_count
+        self.counts_len = struct.counts_len
+
+    def use(self, buffer):
+        # cast() from the address, casting the array itself creates a
+        # reference cycle that keeps the buffer exported until a gc run
+        self.struct.counts = ctypes.cast(ctypes.addressof(buffer), POINTER(int64))
+
+        self.buffer = buffer
+        self.word_size = ctypes.sizeof(buffer._type_)
+        self.counts = memoryview(buffer).cast('B').cast(COUNT_TYPES[self.word_size][1])
+
+    def promote(self, word_size=None):
+        # widens the counts in place, to the next width by default
+        if word_size is None:
+            word_size = self.word_size * 2
+
+        if word_size not in COUNT_TYPES:
+            raise OverflowError('counts cannot be wider than 8 bytes')
+
+        if word_size > self.word_size:
+            self.use((COUNT_TYPES[word_size][0] * self.counts_len)(*self.counts))
+
+    def fit(self, count):
+        # promotes the counts until count fits
+        while count > COUNT_TYPES[self.word_size][2]:
+            self.promote()
+
+    def counts_array(self):
+        numpy = numpy_module()
+        return numpy.asarray(self.counts)
+
+
+class PythonHistogramIterator(HistogramIterator):
+    # rows come from the iterate_* generator of the iteration type
+    def __init__(self, iteration):
+        super(PythonHistogramIterator, self).__init__()
+        self.iteration = iteration
+
+    def fill(self, rows):
+        filled = 0
+
+        for row in islice(self.iteration, len(rows)):
+            rows[filled] = row
+            filled += 1
+
+        return filled
+
+
+class CBackend(object):
+    # libhdr_histogram through ctypes, the histogram handle is the
+    # POINTER(HistogramStruct) filled by hdr_init
+    name = 'c'
+
+    def __init__(self):
+        self.reset = lib.hdr_reset
+        self.record_value = lib.hdr_record_value
+        self.record_values = lib.hdr_record_value_repeat
+        self.record_corrected_value = lib.hdr_record_corrected_value
+        self.add = lib.hdr_add
+        self.lowest_equivalent_value = lib.hdr_lowest_equivalent_value
+        self.min = lib.hdr_min
+        self.max = lib.hdr_max
+        self.mean = lib.hdr_mean
+        self.stddev = lib.hdr_stddev
+        self.value_at_percentile = lib.hdr_value_at_percentile
+
+    def init(self, lowest, highest, significant, word_size=8):
+        histogram = HistogramPointer()
+        self.promote(histogram, word_size)
 
         # return non zero on erro (EINVAL)
-        if hdr_init(int64(lowest), int64(highest), cint(significant), histogram):
+        if lib.hdr_init(int64(lowest), int64(highest), cint(significant), histogram):
             raise Exception('Invalid arguments')
 
-    def __del__(self):
-        clib.free(self.histogram)
+        return histogram
 
-    def __iadd__(self, other):
-        hdr_add(self.histogram, other.histogram)
+    def attach(self, struct, buffer):
+        # the memory is owned by the caller, the handle must not be freed
+        struct.counts = ctypes.cast(ctypes.addressof(buffer), POINTER(int64))
+        return ctypes.pointer(struct)
 
-    def __iter__(self):
-        return self.iter('basic')
+    def free(self, histogram):
+        clib.free(histogram)
 
-    def iter(self, itertype='basic', units_per_bucket=None):
-        return HistogramIterator(self.histogram, itertype, units_per_bucket=units_per_bucket)
+    def word_size(self, histogram):
+        return 8
 
-    # def __len__(self):
-    #     return self.histogram.contents.counts_len
+    def owner(self, histogram):
+        return histogram
 
-    def __getitem__(self, key):
-        if type(key) is not int:
-            raise IndexError
+    def promote(self, histogram, word_size=8):
+        if word_size != 8:
+            raise Exception('the c backend only supports 8 byte counts')
 
-        if key < 0 or key > self.histogram.counts_len:
-            raise IndexError
+    def retire(self, histogram):
+        # a resized histogram's old buffer is freed once no counts view
+        # references it anymore
+        weakref.finalize(histogram, clib.free, ctypes.c_void_p(ctypes.addressof(histogram.contents)))
 
-        raise NotImplemented()
+    def struct(self, histogram):
+        return histogram.contents
 
-    def reset(self):
-        hdr_reset(self.histogram)
+    def iter(self, histogram, itertype='basic', units_per_bucket=None, value_units_first_bucket=None, log_base=None,
+             ticks_per_half_distance=None):
+        iteration_parameters(itertype, units_per_bucket, value_units_first_bucket, log_base, ticks_per_half_distance)
 
-    def record(self, value):
-        if not hdr_record_value(self.histogram, int64(value)):
-            msg = 'value {} is too large (>{}), it cannot be tracked (try increasing significant)'.format(
-                value,
-                self.histogram.contents.highest_trackable_value
-            )
-            raise Exception(msg)
+        if itertype == 'basic':
+            return CBasicIterator(histogram)
+        if itertype == 'recorded':
+            return CRecordedIterator(histogram)
+        if itertype == 'linear':
+            return CLinearIterator(histogram, units_per_bucket)
+        if itertype == 'log':
+            return CLogIterator(histogram, value_units_first_bucket, log_base)
+        return CPercentileIterator(histogram, ticks_per_half_distance)
 
-    def corrected(self, value, interval):
-        if not hdr_record_corrected_value(self.histogram, int64(value), int64(interval)):
-            msg = 'value {} is too large (>{}), it cannot be tracked (try increasing significant)'.format(
-                value,
-                self.histogram.contents.highest_trackable_value
-            )
-            raise Exception(msg)
+    def record_many(self, histogram, values):
+        numpy = numpy_module()
+        values = int64_values(values)
 
-    def record_repeat(self, value, times):
-        hdr_record_value_repeat(self.histogram, int64(value), int64(times))
+        if numpy is None:
+            record_value = lib.hdr_record_value
+            dropped = 0
 
-    def min(self):
-        return hdr_min(self.histogram)
+            for value in values:
+                if not record_value(histogram, value):
+                    dropped += 1
 
-    def max(self):
-        return hdr_max(self.histogram)
+            return dropped
 
-    def mean(self):
-        return hdr_mean(self.histogram)
+        return self.record_array(histogram, values, 0)
 
-    def stddev(self):
-        return hdr_stddev(self.histogram)
+    def record_many_corrected(self, histogram, values, interval):
+        numpy = numpy_module()
+        values = int64_values(values)
 
-    def valued_at_percentile(self, percentile):
-        return hdr_value_at_percentile(self.histogram, cdouble(percentile))
+        if numpy is None:
+            record_corrected_value = lib.hdr_record_corrected_value
+            dropped = 0
 
-    def lowest_equivalent(self, value):
-        return hdr_lowest_equivalent_value(self.histogram, int64(value))
+            for value in values:
+                if not record_corrected_value(histogram, value, interval):
+                    dropped += 1
 
-    def total(self):
-        return self.histogram.contents.total_count
+            return dropped
+
+        return self.record_array(histogram, values, interval)
+
+    def record_array(self, histogram, values, interval):
+        # the counts are updated in place in the library's buffer
+        numpy = numpy_module()
+        struct = histogram.contents
+
+        def counts():
+            return numpy.ctypeslib.as_array(struct.counts, shape=(struct.counts_len,))
+
+        return record_array(struct, struct, counts, values, interval)
+
+
+class PythonBackend(object):
+    # Pure python implementation of the hdr_* functions used by Histogram, the
+    # results are the same as the C library's. When numpy is available the
+    # operations that walk the counts are vectorized.
+    name = 'python'
+
+    def init(self, lowest, highest, significant, word_size=8):
+        struct = HistogramStruct()
+
+        if word_size not in COUNT_TYPES or bucket_config(struct, lowest, highest, significant):
+            raise Exception('Invalid arguments')
+
+        return PythonHistogram(struct, (COUNT_TYPES[word_size][0] * struct.counts_len)())
+
+    def attach(self, struct, buffer):
+        return PythonHistogram(struct, buffer)
+
+    def free(self, histogram):
+        pass
+
+    def word_size(self, histogram):
+        return histogram.word_size
+
+    def owner(self, histogram):
+        return histogram.buffer
+
+    def promote(self, histogram, word_size=8):
+        histogram.promote(word_size)
+
+    def retire(self, histogram):
+        pass
+
+    def struct(self, histogram):
+        return histogram.struct
+
+    def iter(self, histogram, itertype='basic', units_per_bucket=None, value_units_first_bucket=None, log_base=None,
+             ticks_per_half_distance=None):
+        iteration_parameters(itertype, units_per_bucket, value_units_first_bucket, log_base, ticks_per_half_distance)
+
+        return PythonHistogramIterator(iterate_counts(
+            histogram,
+            histogram.counts,
+            histogram.struct.total_count,
+            itertype,
+            units_per_bucket,
+            value_units_first_bucket,
+            log_base,
+            ticks_per_half_distance,
+        ))
+
+    def reset(self, histogram):
+        struct = histogram.struct
+        ctypes.memset(histogram.buffer, 0, ctypes.sizeof(histogram.buffer))
+        struct.total_count = 0
+        struct.min_value = INT64_MAX
+        struct.max_value = 0
+
+    def record_values(self, histogram, value, count):
+        if value < 0:
+            return False
+
+        index = counts_index_for(histogram, value)
+        if index >= histogram.counts_len:
+            return False
+
+        struct = histogram.struct
+        counts = histogram.counts
+        try:
+            counts[index] += count
+        except ValueError:
+            # the count overflowed, raises OverflowError for 8 bytes counts
+            histogram.fit(counts[index] + count)
+            histogram.counts[index] += count
+        struct.total_count += count
+
+        if value < struct.min_value and value != 0:
+            struct.min_value = value
+
+        if value > struct.max_value:
+            struct.max_value = value
+
+        return True
+
+    def record_value(self, histogram, value):
+        return self.record_values(histogram, value, 1)
+
+    def record_corrected_value(self, histogram, value, expected_interval):
+        if not self.record_values(histogram, value, 1):
+            return False
+
+        if expected_interval <= 0 or value <= expected_interval:
+            return True
+
+        missing_value = value - expected_interval
+        while missing_value >= expected_interval:
+            if not self.record_values(histogram, missing_value, 1):
+                return False
+            missing_value -= expected_interval
+
+        return True
+
+    def record_many(self, histogram, values):
+        numpy = numpy_module()
+        values = int64_values(values)
+
+        if numpy is None:
+            record_values = self.record_values
+            dropped = 0
+
+            for value in values:
+                if not record_values(histogram, value, 1):
+                    dropped += 1
+
+            return dropped
+
+        return self.record_array(histogram, values, 0)
+
+    def record_many_corrected(self, histogram, values, interval):
+        numpy = numpy_module()
+
+        if numpy is None:
+            record_corrected_value = self.record_corrected_value
+            dropped = 0
+
+            for value in int64_values(values):
+                if not record_corrected_value(histogram, value, interval):
+                    dropped += 1
+
+            return dropped
+
+        return self.record_array(histogram, int64_values(values), interval)
+
+    def record_array(self, histogram, values, interval):
+        fit = histogram.fit if histogram.word_size != 8 else None
+        return record_array(histogram, histogram.struct, histogram.counts_array, values, interval, fit)
+
+    def add(self, histogram, other):
+        numpy = numpy_module()
+
+        if numpy is None or not same_layout(histogram, other):
+            record_values = self.record_values
+            counts = other.counts
+            dropped = 0
+
+            for index in range(other.counts_len):
+                count = counts[index]
+                if count and not record_values(histogram, value_at_index(other, index), count):
+                    dropped += count
+
+            return dropped
+
+        other_counts = other.counts_array()
+        non_zero = numpy.flatnonzero(other_counts)
+
+        if not len(non_zero):
+            return 0
+
+        struct = histogram.struct
+        if histogram.word_size != 8:
+            histogram.fit(int((histogram.counts_array() + other_counts.astype(numpy.int64)).max()))
+        histogram.counts_array()[:] += other_counts
+        struct.total_count += int(other_counts.sum())
+
+        # the index 0 is the only one with the value 0, which is not a min
+        first = int(non_zero[1] if non_zero[0] == 0 and len(non_zero) > 1 else non_zero[0])
+        if first != 0:
+            struct.min_value = min(struct.min_value, value_at_index(histogram, first))
+        struct.max_value = max(struct.max_value, value_at_index(histogram, int(non_zero[-1])))
+
+        return 0
+
+    def lowest_equivalent_value(self, histogram, value):
+        return lowest_equivalent_value(histogram, value)
+
+    def min(self, histogram):
+        if histogram.counts[0] > 0:
+            return 0
+
+        min_value = histogram.struct.min_value
+        if min_value == INT64_MAX:
+            return INT64_MAX
+
+        return lowest_equivalent_value(histogram, min_value)
+
+    def max(self, histogram):
+        max_value = histogram.struct.max_value
+        if max_value == 0:
+            return 0
+
+        return highest_equivalent_value(histogram, max_value)
+
+    def median_values(self, histogram):
+        # (counts, median equivalent values) of the non empty buckets
+        numpy = numpy_module()
+        counts = histogram.counts_array()
+        non_zero = numpy.flatnonzero(counts)
+        values = index_values(histogram, histogram.counts_len + 1)
+        lowest = values[non_zero]
+        sizes = values[non_zero + 1] - lowest
+        return counts[non_zero], lowest + (sizes >> 1)
+
+    def mean(self, histogram):
+        numpy = numpy_module()
+        total_count = histogram.struct.total_count
+        if total_count == 0:
+            return float('nan')
+
+        if numpy is not None:
+            counts, medians = self.median_values(histogram)
+            return int(numpy.dot(counts, medians)) * 1.0 / total_count
+
+        counts = histogram.counts
+        total = 0
+        for index in range(histogram.counts_len):
+            if counts[index]:
+                total += counts[index] * median_equivalent_value(histogram, value_at_index(histogram, index))
+
+        return total * 1.0 / total_count
+
+    def stddev(self, histogram):
+        numpy = numpy_module()
+        total_count = histogram.struct.total_count
+        if total_count == 0:
+            return float('nan')
+
+        mean = self.mean(histogram)
+
+        # the deviations are accumulated in the same order as the C code
+        if numpy is not None:
+            counts, medians = self.median_values(histogram)
+            deviations = medians * 1.0 - mean
+            geometric_dev_total = float(numpy.cumsum((deviations * deviations) * counts)[-1])
+        else:
+            counts = histogram.counts
+            geometric_dev_total = 0.0
+            for index in range(histogram.counts_len):
+                if counts[index]:
+                    dev = median_equivalent_value(histogram, value_at_index(histogram, index)) * 1.0 - mean
+                    geometric_dev_total += (dev * dev) * counts[index]
+
+        return math.sqrt(geometric_dev_total / total_count)
+
+    def value_at_percentile(self, histogram, percentile):
+        numpy = numpy_module()
+        total_count = histogram.struct.total_count
+        if total_count == 0:
+            return 0
+
+        requested_percentile = min(percentile, 100.0)
+        count_at_percentile = max(int(((requested_percentile / 100) * total_count) + 0.5), 1)
+
+        if numpy is not None:
+            cumulative = numpy.cumsum(histogram.counts_array())
+            index = int(numpy.searchsorted(cumulative, count_at_percentile, side='left'))
+            if index >= histogram.counts_len:
+                return 0
+        else:
+            counts = histogram.counts
+            total = 0
+            for index in range(histogram.counts_len):
+                total += counts[index]
+                if total >= count_at_percentile:
+                    break
+            else:
+                return 0
+
+        return highest_equivalent_value(histogram, value_at_index(histogram, index))
+
+
+if _hdr is not None:
+    class NativeHistogram(_hdr.Handle, PythonHistogram):
+        # a PythonHistogram that the _hdr functions receive directly, the
+        # handle's address is the one of the struct
+        def __init__(self, struct, buffer):
+            PythonHistogram.__init__(self, struct, buffer)
+            self.address = ctypes.addressof(struct)
+
+
+class NativeBackend(PythonBackend):
+    # The compiled _hdr extension, the recording and query functions are
+    # called without the ctypes conversions and the bulk ones release the GIL.
+    # The histograms have the PythonHistogram layout, so everything else is
+    # shared with the python backend.
+    name = 'native'
+
+    def __init__(self):
+        self.record_value = _hdr.record_value
+        self.record_values = _hdr.record_values
+        self.record_corrected_value = _hdr.record_corrected_value
+        self.lowest_equivalent_value = _hdr.lowest_equivalent_value
+        self.min = _hdr.min
+        self.max = _hdr.max
+        self.mean = _hdr.mean
+        self.stddev = _hdr.stddev
+        self.value_at_percentile = _hdr.value_at_percentile
+
+    def init(self, lowest, highest, significant, word_size=8):
+        self.promote(None, word_size)
+
+        struct = HistogramStruct()
+        if bucket_config(struct, lowest, highest, significant):
+            raise Exception('Invalid arguments')
+
+        return NativeHistogram(struct, (int64 * struct.counts_len)())
+
+    def attach(self, struct, buffer):
+        self.promote(None, ctypes.sizeof(buffer._type_))
+        return NativeHistogram(struct, buffer)
+
+    def promote(self, histogram, word_size=8):
+        if word_size != 8:
+            raise Exception('the native backend only supports 8 byte counts')
+
+    def record_many(self, histogram, values):
+        return _hdr.record_many(histogram, int64_values(values))
+
+    def record_many_corrected(self, histogram, values, interval):
+        return _hdr.record_many(histogram, int64_values(values), interval)
+
+
+backends = {'python': PythonBackend()}
+
+if _hdr is not None:
+    backends['native'] = NativeBackend()
+
+
+def load(path=None):
+    # binds the C library and registers the c backend, path defaults to
+    # HDR_HISTOGRAM_LIBRARY or the library searched by the loader
+    global hdrlib, clib, load_error
+
+    if path is None:
+        path = os.environ.get('HDR_HISTOGRAM_LIBRARY', HDR_LIBRARY)
+
+    functions = Library()
+    try:
+        library = ctypes.cdll.LoadLibrary(path)
+        for name, (symbol, arguments_types, return_type) in HDR_FUNCTIONS.items():
+            setattr(functions, name, function(library, symbol, arguments_types, return_type))
+    except (OSError, AttributeError) as e:
+        load_error = 'could not load {}: {}'.format(path, e)
+        raise Exception(load_error)
+
+    if clib is None:
+        # imported here, ctypes.util is slow to import
+        from ctypes.util import find_library
+        clib = ctypes.cdll.LoadLibrary(find_library('c'))
+
+    lib.__dict__.update(functions.__dict__)
+    hdrlib = library
+    load_error = None
+    backends['c'] = CBackend()
+    return backends['c']
+
+
+def get_backend(backend=None):
+    # the compiled extension is preferred, then the C library, which is
+    # loaded by the first call that may use it
+    may_use_c = backend == 'c' or (backend is None and 'native' not in backends)
+    if may_use_c and hdrlib is None and load_error is None:
+        try:
+            load()
+        except Exception:
+            pass
+
+    if backend is None:
+        backend = next(name for name in ('native', 'c', 'python') if name in backends)
+
+    if not isinstance(backend, str):
+        return backend
+
+    try:
+        return backends[backend]
+    except KeyError:
+        if backend == 'c':
+            raise Exception('the c backend is not available, {}'.format(load_error))
+        raise Exception('the {} backend is not available'.format(backend))
+
+
+class FrozenHistogram(object):
+    # Read only view over a Histogram with a cumulative count index of the
+    # non empty buckets, percentile and rank queries are O(log n). The index
+    # is rebuilt on the first query after the source histogram changed.
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.key = None
+        self.indexes = None
+        self.cumulative = None
+
+    def index(self):
+        numpy = numpy_module()
+        histogram = self.histogram
+        key = (histogram.generation, histogram.struct.total_count)
+
+        if key != self.key:
+            counts = histogram.counts
+
+            if numpy is not None:
+                counts = numpy.asarray(counts, dtype=numpy.int64)
+                self.indexes = numpy.flatnonzero(counts)
+                self.cumulative = numpy.cumsum(counts[self.indexes])
+            else:
+                self.indexes = array('q', (index for index in range(len(counts)) if counts[index]))
+                self.cumulative = array('q', accumulate(counts[index] for index in self.indexes))
+
+            self.key = key
+
+        return self.indexes, self.cumulative
+
+    def total(self):
+        return self.histogram.total()
+
+    def min(self):
+        return self.histogram.min()
+
+    def max(self):
+        return self.histogram.max()
+
+    def valued_at_percentile(self, percentile):
+        return self.value_at_percentiles([percentile])[0].value
+
+    def value_at_percentiles(self, percentiles):
+        indexes, cumulative = self.index()
+        struct = self.histogram.struct
+        total_count = struct.total_count
+        result = []
+
+        for percentile in percentiles:
+            target = max(int(((min(percentile, 100.0) / 100) * total_count) + 0.5), 1)
+            position = bisect_left(cumulative, target)
+
+            if total_count == 0 or position == len(cumulative):
+                value = 0
+            else:
+                value = highest_equivalent_value(struct, value_at_index(struct, int(indexes[position])))
+
+            result.append(Percentile(percentile, value))
+
+        return result
+
+    def rank(self, value):
+        # number of recorded values equivalent to or below value
+        if value < 0:
+            return 0
+
+        indexes, cumulative = self.index()
+        position = bisect_right(indexes, counts_index_for(self.histogram.struct, value))
+        return int(cumulative[position - 1]) if position else 0
+
+    def fraction_at_or_below(self, value):
+        total_count = self.histogram.struct.total_count
+        if total_count == 0:
+            return 0.0
+
+        return self.rank(value) * 1.0 / total_count
+
+
+class Histogram(object):
+    # (struct, buffer) of the histograms created with attach()
+    memory = None
+    # the mmap of the histograms created with open_mmap()
+    mapping = None
+    # grow the counts instead of rejecting values above highest
+    auto_resize = False
+
+    CONFIG_FIELDS = {
+        'lowest': 'lowest_trackable_value',
+        'highest': 'highest_trackable_value',
+        'significant': 'significant_figures',
+    }
+
+    def __init__(self, lowest, highest, significant, backend=None, auto_resize=False, word_size=8):
+        # with auto_resize highest is only the initial range, it defaults to
+        # the smallest one
+        if highest is None and auto_resize:
+            highest = 2 * lowest
+
+        self.lowest = lowest
+        self.highest = highest
+        self.significant = significant
+        self.histogram = None
+
+        # bumped by the changes that may not increase total_count, used with
+        # total_count to tell when cached data is stale
+        self.generation = 0
+
+        # only the python backend has counts narrower than 8 bytes
+        if backend is None and word_size != 8:
+            backend = 'python'
+        self.backend = get_backend(backend)
+
+        if lowest < 1:
+            raise Exception('lowest must be larger than 1')
+
+        if lowest * 2 > highest:
+            raise Exception('lowest cannot be larger than highest/2')
+
+        if not (1 < significant < 6):
+            raise Exception('significant must be between 1 and 6 (non inclusive)')
+
+        # word_size is the width of the counts in bytes, the narrower counts
+        # are promoted to the next width when a count overflows
+        self.histogram = self.backend.init(lowest, highest, significant, word_size)
+        self.struct = self.backend.struct(self.histogram)
+        self.auto_resize = auto_resize
+
+    @classmethod
+    def attach(cls, struct, buffer, backend=None):
+        # Histogram over caller owned memory, struct is a HistogramStruct with
+        # the bucket configuration and buffer an int64 array of counts_len
+        # entries. Both are kept alive by the histogram and never freed.
+        histogram = cls.__new__(cls)
+        histogram.lowest = struct.lowest_trackable_value
+        histogram.highest = struct.highest_trackable_value
+        histogram.significant = struct.significant_figures
+        histogram.generation = 0
+        histogram.histogram = None
+        histogram.backend = get_backend(backend)
+        histogram.memory = (struct, buffer)
+        histogram.histogram = histogram.backend.attach(struct, buffer)
+        histogram.struct = histogram.backend.struct(histogram.histogram)
+        return histogram
+
+    @classmethod
+    def open_mmap(cls, path, lowest=None, highest=None, significant=None, backend=None):
+        # Histogram kept in a memory mapped file, the struct included, so a
+        # restarted process reattaches to what was recorded without any
+        # replay. The file uses the native struct layout and must not be
+        # opened by more than one process at a time (the counts pointer in
+        # the struct is rewritten on every open).
+        offset = MMAP_HEADER.size
+        struct_size = ctypes.sizeof(HistogramStruct)
+        counts_offset = offset + struct_size
+        config = None
+
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            config = HistogramStruct()
+            if None in (lowest, highest, significant) or bucket_config(config, lowest, highest, significant):
+                raise Exception('Invalid arguments')
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            if config is not None:
+                os.ftruncate(fd, counts_offset + config.counts_len * ctypes.sizeof(int64))
+                mapping = mmap.mmap(fd, 0)
+                MMAP_HEADER.pack_into(mapping, 0, MMAP_COOKIE, struct_size)
+                mapping[offset:counts_offset] = bytes(config)
+            else:
+                mapping = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+        cookie, size = MMAP_HEADER.unpack_from(mapping, 0)
+        if cookie != MMAP_COOKIE or size != struct_size:
+            raise Exception('{} is not a histogram file for this platform'.format(path))
+
+        struct = HistogramStruct.from_buffer(mapping, offset)
+        for name, value in (('lowest', lowest), ('highest', highest), ('significant', significant)):
+            if value is not None and value != getattr(struct, cls.CONFIG_FIELDS[name]):
+                raise Exception('{} was created with a different {}'.format(path, name))
+
+        buffer = (int64 * struct.counts_len).from_buffer(mapping, counts_offset)
+        histogram = cls.attach(struct, buffer, backend=backend)
+        histogram.mapping = mapping
+        return histogram
+
+    def flush(self):
+        # writes the memory mapped file back to disk
+        if self.mapping is not None:
+            self.mapping.flush()
+
+    def __del__(self):
+        if self.histogram is not None and self.memory is None:
+            self.backend.free(self.histogram)
+
+    def __reduce__(self):
+        # pickled in the compressed encoding, which only has the non empty
+        # buckets, the counts are unpickled 8 bytes wide
+        return (Histogram.decode, (self.encode(), self.backend.name), {'auto_resize': self.auto_resize})
+
+    def __copy__(self):
+        return self.clone()
+
+    def __deepcopy__(self, memo):
+        return self.clone()
+
+    def clone(self):
+        # a new histogram with a copy of the struct and the counts
+        clone = Histogram(
+            self.lowest,
+            self.highest,
+            self.significant,
+            backend=self.backend,
+            auto_resize=self.auto_resize,
+            word_size=self.word_size,
+        )
+
+        # the fields before the counts pointer, which is the last one
+        ctypes.memmove(ctypes.addressof(clone.struct), ctypes.addressof(self.struct), HistogramStruct.counts.offset)
+        clone.counts[:] = self.counts
+
+        return clone
+
+    def __iadd__(self, other):
+        if self.auto_resize:
+            self.resized(other.max())
+
+        self.generation += 1
+
+        # packed histograms and other backends are added bucket by bucket
+        if isinstance(other, Histogram) and other.backend is self.backend:
+            self.backend.add(self.histogram, other.histogram)
+        else:
+            record_values = self.backend.record_values
+            for start, _, count in other.iter('recorded'):
+                record_values(self.histogram, start, count)
+
+        return self
+
+    def __isub__(self, other):
+        return self.subtract(other)
+
+    def subtract(self, other):
+        # removes other's counts, as an earlier copy of a cumulative histogram,
+        # other must have the same layout and no bucket with more values. A
+        # PackedHistogram is expanded to its dense counts first.
+        numpy = numpy_module()
+
+        if not same_layout(self.struct, other.struct):
+            raise Exception('the histograms have different bucket layouts')
+
+        counts = self.counts
+        other_counts = other.dense_counts() if isinstance(other, PackedHistogram) else other.counts
+
+        if numpy is not None:
+            exceeds = bool((numpy.asarray(counts) < numpy.asarray(other_counts)).any())
+        else:
+            exceeds = any(count < other_count for count, other_count in zip(counts, other_counts))
+
+        if exceeds:
+            raise Exception('the histogram has buckets with fewer values than the subtracted one')
+
+        self.generation += 1
+        subtract_counts(counts, other_counts)
+        reset_internal_counters(self.struct, counts)
+
+        return self
+
+    def delta(self, previous):
+        # a new histogram with the values recorded since previous was copied
+        return self.clone().subtract(previous)
+
+    def __iter__(self):
+        return self.iter('basic')
+
+    def iter(self, itertype='basic', units_per_bucket=None, value_units_first_bucket=None, log_base=None,
+             ticks_per_half_distance=None):
+        return self.backend.iter(
+            self.histogram,
+            itertype,
+            units_per_bucket=units_per_bucket,
+            value_units_first_bucket=value_units_first_bucket,
+            log_base=log_base,
+            ticks_per_half_distance=ticks_per_half_distance,
+        )
+
+    def __len__(self):
+        return self.struct.counts_len
+
+    def __getitem__(self, key):
+        if type(key) is not int:
+            raise IndexError
+
+        if key < 0 or key >= self.struct.counts_len:
+            raise IndexError
+
+        if self.word_size != 8:
+            return self.counts[key]
+
+        return self.struct.counts[key]
+
+    @property
+    def word_size(self):
+        return self.backend.word_size(self.histogram)
+
+    def promote(self, word_size=8):
+        # widens the counts ahead of an overflow
+        self.backend.promote(self.histogram, word_size)
+
+    @property
+    def counts(self):
+        # memoryview aliasing the counts owned by the backend (the C library's
+        # buffer included), numpy.asarray() wraps it without copying. The view
+        # keeps the histogram alive.
+        struct = self.struct
+        count_type, count_format, _ = COUNT_TYPES[self.word_size]
+        buffer = (count_type * struct.counts_len).from_address(ctypes.addressof(struct.counts.contents))
+        buffer.histogram = self
+        # the owner of the memory outlives a resize or a promotion
+        buffer.owner = self.backend.owner(self.histogram)
+        return memoryview(buffer).cast('B').cast(count_format)
+
+    def encode(self):
+        # HdrHistogram V2 compressed format, base64 encoded
+        struct = self.struct
+        length = counts_index_for(struct, struct.max_value) + 1 if struct.total_count else 0
+        payload = zigzag_encode_counts(self.counts, length)
+
+        header = ENCODING_HEADER.pack(
+            V2_ENCODING_COOKIE,
+            len(payload),
+            struct.normalizing_index_offset,
+            struct.significant_figures,
+            struct.lowest_trackable_value,
+            struct.highest_trackable_value,
+            struct.conversion_ratio,
+        )
+        compressed = zlib.compress(header + payload)
+
+        return base64.b64encode(COMPRESSION_HEADER.pack(V2_COMPRESSION_COOKIE, len(compressed)) + compressed)
+
+    @classmethod
+    def decode(cls, encoded, backend=None):
+        lowest, highest, significant, conversion_ratio, payload = unpack_encoded(encoded)
+
+        histogram = cls(lowest, highest, significant, backend=backend)
+        zigzag_decode_counts(payload, histogram.counts)
+
+        histogram.struct.conversion_ratio = conversion_ratio
+        reset_internal_counters(histogram.struct, histogram.counts)
+
+        return histogram
+
+    def index_for(self, value):
+        return counts_index_for(self.struct, value)
+
+    def range_at(self, index):
+        start = value_at_index(self.struct, index)
+        return RangeCount(start, highest_equivalent_value(self.struct, start), self[index])
+
+    def value_ranges(self):
+        # (starts, ends) of every index, the end is inclusive
+        numpy = numpy_module()
+        struct = self.struct
+
+        if numpy is not None:
+            values = index_values(struct, struct.counts_len + 1)
+            return values[:-1], values[1:] - 1
+
+        values = array('q', (value_at_index(struct, index) for index in range(struct.counts_len + 1)))
+        return values[:-1], array('q', (value - 1 for value in values[1:]))
+
+    def reset(self):
+        self.generation += 1
+        self.backend.reset(self.histogram)
+
+    def freeze(self):
+        return FrozenHistogram(self)
+
+    def resize(self, value):
+        # Grows the counts to cover value. The layout of the lower buckets
+        # does not depend on highest, so the counts are copied as they are
+        # into the new buffer.
+        highest = min(max(value, self.struct.highest_trackable_value * 2), INT64_MAX)
+        handle = self.backend.init(self.lowest, highest, self.significant, self.word_size)
+        struct = self.backend.struct(handle)
+        counts = self.counts
+
+        for name in ('total_count', 'min_value', 'max_value', 'conversion_ratio'):
+            setattr(struct, name, getattr(self.struct, name))
+
+        retired = self.histogram
+        self.histogram = handle
+        self.struct = struct
+        self.highest = highest
+        self.counts[:len(counts)] = counts
+        self.generation += 1
+        self.backend.retire(retired)
+
+    def resized(self, value):
+        # auto_resize hook for the values that could not be recorded, returns
+        # False when growing cannot help
+        if not self.auto_resize or value <= self.struct.highest_trackable_value:
+            return False
+
+        self.resize(value)
+        return True
+
+    def record(self, value):
+        if not self.backend.record_value(self.histogram, value):
+            if self.resized(value):
+                return self.record(value)
+
+            msg = 'value {} is too large (>{}), it cannot be tracked (try increasing significant)'.format(
+                value,
+                self.struct.highest_trackable_value
+            )
+            raise Exception(msg)
+
+    def corrected(self, value, interval):
+        if not self.backend.record_corrected_value(self.histogram, value, interval):
+            if self.resized(value):
+                return self.corrected(value, interval)
+
+            msg = 'value {} is too large (>{}), it cannot be tracked (try increasing significant)'.format(
+                value,
+                self.struct.highest_trackable_value
+            )
+            raise Exception(msg)
+
+    def corrected_copy(self, expected_interval):
+        # A new histogram with the values corrected() would have added for
+        # every recorded value, computed from the counts. As in
+        # hdr_add_while_correcting_for_coordinated_omission() each bucket is
+        # corrected from its lowest value.
+        numpy = numpy_module()
+        copy = Histogram(self.lowest, self.highest, self.significant, backend=self.backend.name)
+        struct = self.struct
+        counts = copy.counts
+
+        if numpy is not None:
+            source = numpy.asarray(self.counts, dtype=numpy.int64)
+            target = numpy.frombuffer(counts, dtype=numpy.int64)
+            target[:] = source
+
+            if expected_interval > 0:
+                non_zero = numpy.flatnonzero(source)
+                starts = index_values(struct, struct.counts_len + 1)[non_zero]
+                target += missing_counts(struct, starts, source[non_zero], expected_interval, struct.counts_len)
+        else:
+            source = self.counts
+            counts[:] = source
+
+            for index in range(struct.counts_len):
+                count = source[index]
+                value = value_at_index(struct, index)
+                quotient, remainder = divmod(value, expected_interval) if expected_interval > 0 else (0, 0)
+
+                if count == 0 or quotient < 2:
+                    continue
+
+                # the missing values are remainder + m * expected_interval
+                # for m in 1..quotient-1, counted per bucket
+                up_to_lowest = 0
+                for target in range(counts_index_for(struct, remainder + expected_interval), index + 1):
+                    highest = value_at_index(struct, target + 1) - 1
+                    up_to_highest = min(max((highest - remainder) // expected_interval, 0), quotient - 1)
+                    counts[target] += (up_to_highest - up_to_lowest) * count
+                    up_to_lowest = up_to_highest
+
+        reset_internal_counters(copy.struct, counts)
+        return copy
+
+    def record_many(self, values):
+        # returns the number of values that could not be tracked instead of
+        # raising, the in range values are recorded regardless
+        if self.auto_resize:
+            values = self.resized_for(values)
+
+        return self.backend.record_many(self.histogram, values)
+
+    def record_many_corrected(self, values, interval):
+        if self.auto_resize:
+            values = self.resized_for(values)
+
+        return self.backend.record_many_corrected(self.histogram, values, interval)
+
+    def resized_for(self, values):
+        numpy = numpy_module()
+        values = int64_values(values)
+
+        if len(values):
+            self.resized(int(numpy.max(values)) if numpy is not None else max(values))
+
+        return values
+
+    def record_repeat(self, value, times):
+        if not self.backend.record_values(self.histogram, value, times) and self.resized(value):
+            self.backend.record_values(self.histogram, value, times)
+
+    def min(self):
+        return self.backend.min(self.histogram)
+
+    def max(self):
+        return self.backend.max(self.histogram)
+
+    def mean(self):
+        return self.backend.mean(self.histogram)
+
+    def stddev(self):
+        return self.backend.stddev(self.histogram)
+
+    def valued_at_percentile(self, percentile):
+        return self.backend.value_at_percentile(self.histogram, percentile)
+
+    def to_arrays(self, itertype='basic', units_per_bucket=None, value_units_first_bucket=None, log_base=None,
+                  ticks_per_half_distance=None):
+        # The rows of an iteration as contiguous columns in a single pass:
+        # RangeCount(starts, ends, counts) or, for the percentile iteration,
+        # Percentile(percentiles, values). numpy arrays when numpy is
+        # available, array('q')/array('d') otherwise.
+        numpy = numpy_module()
+        parameters = (units_per_bucket, value_units_first_bucket, log_base, ticks_per_half_distance)
+        iteration_parameters(itertype, *parameters)
+
+        if numpy is not None:
+            return iteration_arrays(self.struct, self.counts, self.struct.total_count, itertype, *parameters)
+
+        rows = list(iterate_counts(self.struct, self.counts, self.struct.total_count, itertype, *parameters))
+        columns = list(zip(*rows)) or [(), (), ()]
+
+        if itertype == 'percentile':
+            return Percentile(array('d', columns[0]), array('q', columns[1]))
+
+        return RangeCount(*(array('q', column) for column in columns))
+
+    def value_at_percentiles(self, percentiles):
+        # answers all the percentiles with a single walk over the counts
+        percentiles = list(percentiles)
+        values = values_at_percentiles(self.struct, self.counts, self.struct.total_count, percentiles)
+        return [Percentile(percentile, value) for percentile, value in zip(percentiles, values)]
+
+    def lowest_equivalent(self, value):
+        return self.backend.lowest_equivalent_value(self.histogram, value)
+
+    def total(self):
+        return self.struct.total_count
+
+
+class PackedHistogram(object):
+    # Histogram with the bucket math of Histogram that only keeps the non
+    # empty buckets, as the sorted parallel arrays indexes (counts indexes)
+    # and bucket_counts.
+    # That is 16 bytes per recorded bucket instead of 8 bytes for every
+    # bucket, recording into a new bucket is an insertion in the arrays.
+    def __init__(self, lowest, highest, significant):
+        self.lowest = lowest
+        self.highest = highest
+        self.significant = significant
+
+        if lowest < 1:
+            raise Exception('lowest must be larger than 1')
+
+        if lowest * 2 > highest:
+            raise Exception('lowest cannot be larger than highest/2')
+
+        if not (1 < significant < 6):
+            raise Exception('significant must be between 1 and 6 (non inclusive)')
+
+        self.struct = HistogramStruct()
+        if bucket_config(self.struct, lowest, highest, significant):
+            raise Exception('Invalid arguments')
+
+        self.indexes = array('q')
+        self.bucket_counts = array('q')
+
+    @classmethod
+    def from_histogram(cls, histogram):
+        numpy = numpy_module()
+        packed = cls(histogram.lowest, histogram.highest, histogram.significant)
+        counts = histogram.counts
+
+        if numpy is not None:
+            dense = numpy.asarray(counts, dtype=numpy.int64)
+            non_zero = numpy.flatnonzero(dense)
+            packed.indexes.frombytes(non_zero.astype(numpy.int64).tobytes())
+            packed.bucket_counts.frombytes(dense[non_zero].tobytes())
+        else:
+            packed.indexes.extend(index for index in range(len(counts)) if counts[index])
+            packed.bucket_counts.extend(counts[index] for index in packed.indexes)
+
+        for name in ('total_count', 'min_value', 'max_value'):
+            setattr(packed.struct, name, getattr(histogram.struct, name))
+
+        return packed
+
+    def to_histogram(self, backend=None):
+        histogram = Histogram(self.lowest, self.highest, self.significant, backend=backend)
+        counts = histogram.counts
+
+        for index, count in zip(self.indexes, self.bucket_counts):
+            counts[index] = count
+
+        for name in ('total_count', 'min_value', 'max_value'):
+            setattr(histogram.struct, name, getattr(self.struct, name))
+
+        return histogram
+
+    def dense_counts(self):
+        counts = array('q', bytes(self.struct.counts_len * 8))
+
+        for index, count in zip(self.indexes, self.bucket_counts):
+            counts[index] = count
+
+        return counts
+
+    def __iadd__(self, other):
+        # takes packed and dense histograms, like hdr_add() the buckets are
+        # recorded by their lowest value
+        for start, _, count in other.iter('recorded'):
+            self.record_values(start, count)
+
+        return self
+
+    def __iter__(self):
+        return self.iter('basic')
+
+    def iter(self, itertype='basic', units_per_bucket=None, value_units_first_bucket=None, log_base=None,
+             ticks_per_half_distance=None):
+        iteration_parameters(itertype, units_per_bucket, value_units_first_bucket, log_base, ticks_per_half_distance)
+
+        if itertype == 'recorded':
+            struct = self.struct
+            return PythonHistogramIterator(
+                RangeCount(value_at_index(struct, index), value_at_index(struct, index + 1) - 1, count)
+                for index, count in zip(self.indexes, self.bucket_counts)
+            )
+
+        return PythonHistogramIterator(iterate_counts(
+            self.struct,
+            self.dense_counts(),
+            self.struct.total_count,
+            itertype,
+            units_per_bucket,
+            value_units_first_bucket,
+            log_base,
+            ticks_per_half_distance,
+        ))
+
+    def __len__(self):
+        return self.struct.counts_len
+
+    def __getitem__(self, key):
+        if type(key) is not int:
+            raise IndexError
+
+        if key < 0 or key >= self.struct.counts_len:
+            raise IndexError
+
+        position = bisect_left(self.indexes, key)
+        if position < len(self.indexes) and self.indexes[position] == key:
+            return self.bucket_counts[position]
+
+        return 0
+
+    def __reduce__(self):
+        return (PackedHistogram.decode, (self.encode(),))
+
+    def encode(self):
+        return self.to_histogram().encode()
+
+    @classmethod
+    def decode(cls, encoded):
+        return cls.from_histogram(Histogram.decode(encoded))
+
+    def reset(self):
+        del self.indexes[:]
+        del self.bucket_counts[:]
+        self.struct.total_count = 0
+        self.struct.min_value = INT64_MAX
+        self.struct.max_value = 0
+
+    def record_values(self, value, count):
+        struct = self.struct
+
+        if value < 0:
+            return False
+
+        index = counts_index_for(struct, value)
+        if index >= struct.counts_len:
+            return False
+
+        indexes = self.indexes
+        position = bisect_left(indexes, index)
+
+        if position < len(indexes) and indexes[position] == index:
+            self.bucket_counts[position] += count
+        else:
+            indexes.insert(position, index)
+            self.bucket_counts.insert(position, count)
+
+        struct.total_count += count
+
+        if value < struct.min_value and value != 0:
+            struct.min_value = value
+
+        if value > struct.max_value:
+            struct.max_value = value
+
+        return True
+
+    def record_corrected_value(self, value, interval):
+        if not self.record_values(value, 1):
+            return False
+
+        if interval <= 0 or value <= interval:
+            return True
+
+        missing_value = value - interval
+        while missing_value >= interval:
+            if not self.record_values(missing_value, 1):
+                return False
+            missing_value -= interval
+
+        return True
+
+    def record(self, value):
+        if not self.record_values(value, 1):
+            msg = 'value {} is too large (>{}), it cannot be tracked (try increasing significant)'.format(
+                value,
+                self.struct.highest_trackable_value
+            )
+            raise Exception(msg)
+
+    def corrected(self, value, interval):
+        if not self.record_corrected_value(value, interval):
+            msg = 'value {} is too large (>{}), it cannot be tracked (try increasing significant)'.format(
+                value,
+                self.struct.highest_trackable_value
+            )
+            raise Exception(msg)
+
+    def record_many(self, values):
+        dropped = 0
+
+        for value in int64_values(values):
+            if not self.record_values(value, 1):
+                dropped += 1
+
+        return dropped
+
+    def record_many_corrected(self, values, interval):
+        dropped = 0
+
+        for value in int64_values(values):
+            if not self.record_corrected_value(value, interval):
+                dropped += 1
+
+        return dropped
+
+    def record_repeat(self, value, times):
+        self.record_values(value, times)
+
+    def min(self):
+        if self[0] > 0:
+            return 0
+
+        if self.struct.min_value == INT64_MAX:
+            return INT64_MAX
+
+        return lowest_equivalent_value(self.struct, self.struct.min_value)
+
+    def max(self):
+        if self.struct.max_value == 0:
+            return 0
+
+        return highest_equivalent_value(self.struct, self.struct.max_value)
+
+    def mean(self):
+        struct = self.struct
+        if struct.total_count == 0:
+            return float('nan')
+
+        total = 0
+        for index, count in zip(self.indexes, self.bucket_counts):
+            total += count * median_equivalent_value(struct, value_at_index(struct, index))
+
+        return total * 1.0 / struct.total_count
+
+    def stddev(self):
+        struct = self.struct
+        if struct.total_count == 0:
+            return float('nan')
+
+        mean = self.mean()
+        geometric_dev_total = 0.0
+
+        for index, count in zip(self.indexes, self.bucket_counts):
+            dev = median_equivalent_value(struct, value_at_index(struct, index)) * 1.0 - mean
+            geometric_dev_total += (dev * dev) * count
+
+        return math.sqrt(geometric_dev_total / struct.total_count)
+
+    def valued_at_percentile(self, percentile):
+        return self.value_at_percentiles([percentile])[0].value
+
+    def value_at_percentiles(self, percentiles):
+        struct = self.struct
+        total_count = struct.total_count
+        cumulative = list(accumulate(self.bucket_counts))
+        result = []
+
+        for percentile in percentiles:
+            target = max(int(((min(percentile, 100.0) / 100) * total_count) + 0.5), 1)
+            position = bisect_left(cumulative, target)
+
+            if total_count == 0 or position == len(cumulative):
+                value = 0
+            else:
+                value = highest_equivalent_value(struct, value_at_index(struct, self.indexes[position]))
+
+            result.append(Percentile(percentile, value))
+
+        return result
+
+    def lowest_equivalent(self, value):
+        return lowest_equivalent_value(self.struct, value)
+
+    def total(self):
+        return self.struct.total_count
+
+
+class DoubleHistogram(object):
+    # Histogram of non negative float values over an integer Histogram, a
+    # value is recorded as int(value * ratio). The ratio is a power of two
+    # picked so the smallest value recorded maps to the first integer with
+    # the full precision, the covered range shifts when a value falls out of
+    # it as long as the values span at most highest_to_lowest_ratio. The
+    # integer to double ratio is kept in the struct's conversion_ratio.
+    def __init__(self, highest_to_lowest_ratio, significant, backend=None):
+        if highest_to_lowest_ratio < 2:
+            raise Exception('highest_to_lowest_ratio must be at least 2')
+
+        probe = HistogramStruct()
+        if bucket_config(probe, 1, 2, significant):
+            raise Exception('Invalid arguments')
+
+        # integers below precise lose precision, the extra power of two makes
+        # room for a lowest value that is not a power of two
+        self.precise = probe.sub_bucket_count
+        self.span = 1 << max(1, int(math.ceil(math.log(highest_to_lowest_ratio, 2))))
+        self.highest_to_lowest_ratio = highest_to_lowest_ratio
+        self.significant = significant
+
+        if self.precise * self.span > INT64_MAX // 4:
+            raise Exception('highest_to_lowest_ratio is too large for the significant digits')
+
+        self.histogram = Histogram(1, 2 * self.precise * self.span, significant, backend=backend)
+        self.use_ratio(1.0)
+
+    def use_ratio(self, ratio):
+        self.ratio = ratio
+        self.histogram.struct.conversion_ratio = 1.0 / ratio
+
+    def recorded_range(self):
+        # (lowest non zero, highest) recorded values, None when empty
+        histogram = self.histogram
+        lowest = histogram.struct.min_value
+
+        if lowest == INT64_MAX:
+            return None
+
+        conversion_ratio = histogram.struct.conversion_ratio
+        return lowest * conversion_ratio, histogram.max() * conversion_ratio
+
+    def cover(self, lowest, highest):
+        # shifts the range to the values from lowest to highest (lowest is
+        # not zero), returns False when they span more than the histogram can
+        recorded = self.recorded_range()
+        if recorded is not None:
+            lowest = min(lowest, recorded[0])
+            highest = max(highest, recorded[1])
+
+        if highest > lowest * self.span:
+            return False
+
+        # the largest power of two up to lowest maps to precise
+        ratio = self.precise / math.ldexp(1.0, math.frexp(lowest)[1] - 1)
+        if ratio == self.ratio:
+            return True
+
+        factor = ratio / self.ratio
+        source = self.histogram
+        histogram = Histogram(source.lowest, source.highest, source.significant, backend=source.backend.name)
+
+        for start, _, count in source.iter('recorded'):
+            histogram.record_repeat(int(start * factor), count)
+
+        self.histogram = histogram
+        self.use_ratio(ratio)
+        return True
+
+    def integer(self, value):
+        # the integer recorded for value, shifting the range to it first
+        if value < 0:
+            raise Exception('value {} is negative, it cannot be tracked'.format(value))
+
+        integer = int(value * self.ratio)
+
+        if value > 0 and (integer < self.precise or integer > self.histogram.highest):
+            if not self.cover(value, value):
+                raise Exception('value {} is out of the range of {} (highest_to_lowest_ratio {})'.format(
+                    value,
+                    self.recorded_range(),
+                    self.highest_to_lowest_ratio,
+                ))
+
+            integer = int(value * self.ratio)
+
+        return integer
+
+    def cover_most(self, positive):
+        # shifts the range to the values of positive (sorted) that fit in it
+        # along with the recorded ones, the range holding the most of them
+        numpy = numpy_module()
+        span = self.span
+        recorded = self.recorded_range()
+        bounds = (0.0, float('inf')) if recorded is None else (recorded[1] / span, recorded[0])
+
+        if numpy is not None:
+            lowests = numpy.clip(positive, *bounds)
+            held = numpy.searchsorted(positive, lowests * span, side='right') - numpy.searchsorted(positive, lowests)
+            lowest = float(lowests[int(numpy.argmax(held))])
+        else:
+            lowests = [min(max(value, bounds[0]), bounds[1]) for value in positive]
+            held = [bisect_right(positive, lowest * span) - bisect_left(positive, lowest) for lowest in lowests]
+            lowest = lowests[held.index(max(held))]
+
+        self.cover(lowest, lowest)
+
+    def integers(self, values):
+        # int64 integers for a batch of values, the range is shifted once to
+        # the whole batch, or to the part of it that fits when the batch
+        # spans too much. Negative values, and the values left out of the
+        # range, become -1 and are dropped by record_many().
+        numpy = numpy_module()
+        precise = self.precise
+
+        if numpy is not None:
+            values = numpy.asarray(values, dtype=numpy.float64)
+            positive = values[values > 0]
+
+            if len(positive) and not self.cover(float(positive.min()), float(positive.max())):
+                self.cover_most(numpy.sort(positive))
+
+            integers = (values * self.ratio).astype(numpy.int64)
+            outside = (integers < precise) | (integers > self.histogram.highest)
+            integers[(values < 0) | ((values > 0) & outside)] = -1
+            return integers
+
+        values = array('d', values)
+        positive = [value for value in values if value > 0]
+
+        if positive and not self.cover(min(positive), max(positive)):
+            self.cover_most(sorted(positive))
+
+        ratio = self.ratio
+        highest = self.histogram.highest
+        integers = array('q')
+
+        for value in values:
+            integer = int(value * ratio) if value >= 0 else -1
+            if value > 0 and not precise <= integer <= highest:
+                integer = -1
+            integers.append(integer)
+
+        return integers
+
+    def __iadd__(self, other):
+        recorded = other.recorded_range()
+        if recorded is not None and not self.cover(*recorded):
+            raise Exception('the values of the histograms span more than highest_to_lowest_ratio')
+
+        factor = self.ratio * other.histogram.struct.conversion_ratio
+        for start, _, count in other.histogram.iter('recorded'):
+            self.histogram.record_repeat(int(start * factor), count)
+
+        return self
+
+    def __reduce__(self):
+        return (DoubleHistogram.decode, (self.encode(), self.histogram.backend.name))
+
+    def encode(self):
+        # the integer histogram, conversion_ratio is part of the V2 header
+        return self.histogram.encode()
+
+    @classmethod
+    def decode(cls, encoded, backend=None):
+        histogram = Histogram.decode(encoded, backend=backend)
+        double = cls(2, histogram.significant, backend=backend)
+        double.span = histogram.highest // (2 * double.precise)
+        double.highest_to_lowest_ratio = double.span
+        double.histogram = histogram
+        double.use_ratio(1.0 / histogram.struct.conversion_ratio)
+        return double
+
+    def reset(self):
+        self.histogram.reset()
+        self.use_ratio(1.0)
+
+    # the integers are computed first, shifting the range replaces the
+    # integer histogram
+    def record(self, value):
+        integer = self.integer(value)
+        self.histogram.record(integer)
+
+    def record_repeat(self, value, times):
+        integer = self.integer(value)
+        self.histogram.record_repeat(integer, times)
+
+    def corrected(self, value, interval):
+        integer = self.integer(value)
+        self.histogram.corrected(integer, int(interval * self.ratio))
+
+    def record_many(self, values):
+        # the values are converted in bulk, returns the number of values that
+        # could not be tracked
+        integers = self.integers(values)
+        return self.histogram.record_many(integers)
+
+    def record_many_corrected(self, values, interval):
+        integers = self.integers(values)
+        return self.histogram.record_many_corrected(integers, int(interval * self.ratio))
+
+    def min(self):
+        if self.histogram.total() == 0:
+            return 0.0
+
+        return self.histogram.min() * self.histogram.struct.conversion_ratio
+
+    def max(self):
+        return self.histogram.max() * self.histogram.struct.conversion_ratio
+
+    def mean(self):
+        return self.histogram.mean() * self.histogram.struct.conversion_ratio
+
+    def stddev(self):
+        return self.histogram.stddev() * self.histogram.struct.conversion_ratio
+
+    def valued_at_percentile(self, percentile):
+        return self.histogram.valued_at_percentile(percentile) * self.histogram.struct.conversion_ratio
+
+    def value_at_percentiles(self, percentiles):
+        conversion_ratio = self.histogram.struct.conversion_ratio
+        return [
+            Percentile(percentile, value * conversion_ratio)
+            for percentile, value in self.histogram.value_at_percentiles(percentiles)
+        ]
+
+    def lowest_equivalent(self, value):
+        return self.histogram.lowest_equivalent(int(value * self.ratio)) * self.histogram.struct.conversion_ratio
+
+    def total(self):
+        return self.histogram.total()
+
+
+def sum_counts(histograms):
+    numpy = numpy_module()
+    counts = numpy.zeros(histograms[0].struct.counts_len, dtype=numpy.int64)
+
+    for histogram in histograms:
+        counts += numpy.asarray(histogram.counts)
+
+    return counts
+
+
+def merge(histograms, workers=None):
+    # Merges the histograms into a new one configured like the first. The
+    # histograms are split into one group per worker, the groups are summed
+    # on a thread pool and the partial results are folded together. When
+    # every layout matches and numpy is available the counts arrays are
+    # summed directly, otherwise the groups are folded with +=, the ctypes
+    # calls into hdr_add release the GIL.
+    numpy = numpy_module()
+    histograms = list(histograms)
+
+    if not histograms:
+        raise Exception('merge requires at least one histogram')
+
+    # the first histogram may be a PackedHistogram, which has no backend
+    first = histograms[0]
+    backend = first.backend.name if isinstance(first, Histogram) else None
+    result = Histogram(first.lowest, first.highest, first.significant, backend=backend)
+
+    workers = min(workers or os.cpu_count() or 1, len(histograms))
+    groups = [histograms[worker::workers] for worker in range(workers)]
+    vectorized = numpy is not None and all(
+        isinstance(other, Histogram) and same_layout(result.struct, other.struct)
+        for other in histograms
+    )
+
+    def fold(group):
+        if vectorized:
+            return sum_counts(group)
+
+        partial = Histogram(first.lowest, first.highest, first.significant, backend=backend)
+        for histogram in group:
+            partial += histogram
+        return partial
+
+    if workers == 1:
+        partials = [fold(groups[0])]
+    else:
+        # imported here, concurrent.futures is slow to import
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(workers) as pool:
+            partials = list(pool.map(fold, groups))
+
+    if vectorized:
+        numpy.sum(partials, axis=0, out=numpy.frombuffer(result.counts, dtype=numpy.int64))
+        reset_internal_counters(result.struct, result.counts)
+    else:
+        for partial in partials:
+            result += partial
+
+    return result
+
+
+class RecorderShard(object):
+    # histograms of a single writer thread, the lock is only contended while
+    # the reporter swaps them
+    def __init__(self, active, inactive):
+        self.lock = threading.Lock()
+        self.thread = threading.current_thread()
+        self.active = active
+        self.inactive = inactive
+
+
+class Recorder(object):
+    # Modeled on HdrHistogram's Recorder. Every thread records into its own
+    # shard, so writers never wait on each other, and
+    # get_interval_histogram() swaps the active and inactive histograms of
+    # each shard and merges what was recorded since the previous call.
+    #
+    # Python has no atomic swap to build the Java phaser on, an uncontended
+    # per shard lock takes its place.
+    def __init__(self, lowest, highest, significant, backend=None):
+        self.lowest = lowest
+        self.highest = highest
+        self.significant = significant
+        self.backend = get_backend(backend)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+
+    def histogram(self):
+        return Histogram(self.lowest, self.highest, self.significant, backend=self.backend)
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = RecorderShard(self.histogram(), self.histogram())
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def record(self, value):
+        shard = self.shard()
+        with shard.lock:
+            shard.active.record(value)
+
+    def corrected(self, value, interval):
+        shard = self.shard()
+        with shard.lock:
+            shard.active.corrected(value, interval)
+
+    def record_repeat(self, value, times):
+        shard = self.shard()
+        with shard.lock:
+            shard.active.record_repeat(value, times)
+
+    def record_many(self, values):
+        shard = self.shard()
+        with shard.lock:
+            return shard.active.record_many(values)
+
+    def get_interval_histogram(self, histogram=None):
+        # histogram is reset and reused for the result when given
+        if histogram is None:
+            histogram = self.histogram()
+        else:
+            histogram.reset()
+
+        with self.lock:
+            shards = list(self.shards)
+
+        finished = []
+        for shard in shards:
+            # checked before the swap, a thread that is already dead cannot
+            # record into the new active histogram and the shard is drained
+            if not shard.thread.is_alive():
+                finished.append(shard)
+
+            with shard.lock:
+                shard.active, shard.inactive = shard.inactive, shard.active
+
+            histogram += shard.inactive
+            shard.inactive.reset()
+
+        if finished:
+            with self.lock:
+                self.shards = [shard for shard in self.shards if shard not in finished]
+
+        return histogram
+
+    def reset(self):
+        self.get_interval_histogram()
+
+
+class SlidingWindowHistogram(object):
+    # The values recorded in the last window seconds, in a ring of slots
+    # histograms of window / slots seconds each and their running aggregate.
+    # Values are recorded into the current slot and the aggregate, once a slot
+    # leaves the window its counts are subtracted from the aggregate, so the
+    # queries cost the same as on a single histogram whatever the window.
+    # The clock must be monotonic, a step backwards raises.
+    def __init__(self, window, slots, lowest, highest, significant, backend=None, clock=time.monotonic):
+        if window <= 0:
+            raise Exception('window must be positive, got {}'.format(window))
+
+        if slots < 1:
+            raise Exception('slots must be at least 1, got {}'.format(slots))
+
+        self.window = window
+        self.slots = slots
+        self.interval = float(window) / slots
+        self.clock = clock
+        self.aggregate = Histogram(lowest, highest, significant, backend=backend)
+        self.ring = [
+            Histogram(lowest, highest, significant, backend=self.aggregate.backend)
+            for _ in range(slots)
+        ]
+        self.epoch = self.current_epoch()
+
+    def current_epoch(self):
+        return int(self.clock() // self.interval)
+
+    def advance(self):
+        # expires the slots that left the window, returns the current one
+        epoch = self.current_epoch()
+
+        if epoch < self.epoch:
+            raise Exception('the clock went backwards, from slot {} to slot {}'.format(self.epoch, epoch))
+
+        if epoch - self.epoch >= self.slots:
+            self.aggregate.reset()
+            for slot in self.ring:
+                slot.reset()
+        else:
+            for expired in range(self.epoch + 1, epoch + 1):
+                self.expire(self.ring[expired % self.slots])
+
+        self.epoch = epoch
+        return self.ring[self.epoch % self.slots]
+
+    def expire(self, slot):
+        if not slot.total():
+            return
+
+        self.aggregate.subtract(slot)
+        slot.reset()
+
+    def histogram(self):
+        # the aggregate of the window, it must not be recorded into
+        self.advance()
+        return self.aggregate
+
+    def reset(self):
+        self.aggregate.reset()
+        for slot in self.ring:
+            slot.reset()
+
+    def record(self, value):
+        self.advance().record(value)
+        self.aggregate.record(value)
+
+    def corrected(self, value, interval):
+        self.advance().corrected(value, interval)
+        self.aggregate.corrected(value, interval)
+
+    def record_repeat(self, value, times):
+        self.advance().record_repeat(value, times)
+        self.aggregate.record_repeat(value, times)
+
+    def record_many(self, values):
+        slot = self.advance()
+        values = int64_values(values)
+        self.aggregate.record_many(values)
+        return slot.record_many(values)
+
+    def record_many_corrected(self, values, interval):
+        slot = self.advance()
+        values = int64_values(values)
+        self.aggregate.record_many_corrected(values, interval)
+        return slot.record_many_corrected(values, interval)
+
+    def min(self):
+        return self.histogram().min()
+
+    def max(self):
+        return self.histogram().max()
+
+    def mean(self):
+        return self.histogram().mean()
+
+    def stddev(self):
+        return self.histogram().stddev()
+
+    def valued_at_percentile(self, percentile):
+        return self.histogram().valued_at_percentile(percentile)
+
+    def value_at_percentiles(self, percentiles):
+        return self.histogram().value_at_percentiles(percentiles)
+
+    def total(self):
+        return self.histogram().total()
+
+
+class HistogramRegistry(object):
+    # One histogram per key, created on first use, for high cardinality
+    # labels. The histograms share a layout, they and the spilled keys use at
+    # most budget bytes. When a new key does not fit the least recently used
+    # one is evicted, with spill its encoded form is kept and decoded back on
+    # its next use, the oldest spilled keys are dropped once they do not fit.
+    # Evicted and recycled histograms are reset and reused for the next keys
+    # instead of allocating new counts.
+    #
+    # A histogram returned by get() belongs to its key only until the key is
+    # evicted, it is then reused for another key. Use the record methods or
+    # call get() again instead of keeping it.
+    def __init__(self, budget, lowest, highest, significant, spill=False, backend=None):
+        struct = HistogramStruct()
+        if bucket_config(struct, lowest, highest, significant):
+            raise Exception('Invalid arguments')
+
+        self.struct = struct
+        self.histogram_size = ctypes.sizeof(HistogramStruct) + struct.counts_len * ctypes.sizeof(int64)
+        if budget < self.histogram_size:
+            raise Exception('the budget is smaller than a histogram ({} bytes)'.format(self.histogram_size))
+
+        self.budget = budget
+        self.lowest = lowest
+        self.highest = highest
+        self.significant = significant
+        self.spill = spill
+        self.backend = get_backend(backend)
+        self.lock = threading.Lock()
+        self.histograms = OrderedDict()
+        self.spilled = OrderedDict()
+        self.spilled_bytes = 0
+        self.pool = []
+
+    def __len__(self):
+        return len(self.histograms) + len(self.spilled)
+
+    def __contains__(self, key):
+        return key in self.histograms or key in self.spilled
+
+    def keys(self):
+        return list(self.histograms) + list(self.spilled)
+
+    def memory(self):
+        # bytes used by the live and pooled histograms and the spilled keys
+        return (len(self.histograms) + len(self.pool)) * self.histogram_size + self.spilled_bytes
+
+    def fits(self, size):
+        return self.memory() + size <= self.budget
+
+    def trim(self, size):
+        # drops the oldest spilled keys until size more bytes fit
+        while self.spilled and not self.fits(size):
+            self.spilled_bytes -= len(self.spilled.popitem(last=False)[1])
+
+    def unspill(self, key):
+        encoded = self.spilled.pop(key, None)
+        if encoded is not None:
+            self.spilled_bytes -= len(encoded)
+        return encoded
+
+    def get(self, key):
+        with self.lock:
+            return self.acquire(key)
+
+    def acquire(self, key):
+        # must be called with the lock held
+        histograms = self.histograms
+
+        histogram = histograms.get(key)
+        if histogram is not None:
+            histograms.move_to_end(key)
+            return histogram
+
+        encoded = self.unspill(key)
+
+        if self.pool:
+            histogram = self.pool.pop()
+        elif histograms and not self.fits(self.histogram_size):
+            evicted, histogram = histograms.popitem(last=False)
+            if self.spill and histogram.total():
+                spilled = histogram.encode()
+                self.spilled[evicted] = spilled
+                self.spilled_bytes += len(spilled)
+                self.trim(self.histogram_size)
+            histogram.reset()
+        else:
+            self.trim(self.histogram_size)
+            histogram = Histogram(self.lowest, self.highest, self.significant, backend=self.backend)
+
+        if encoded is not None:
+            conversion_ratio, payload = unpack_encoded(encoded)[3:]
+            zigzag_decode_counts(payload, histogram.counts)
+            histogram.struct.conversion_ratio = conversion_ratio
+            reset_internal_counters(histogram.struct, histogram.counts)
+
+        histograms[key] = histogram
+        return histogram
+
+    def remove(self, key):
+        with self.lock:
+            self.unspill(key)
+            histogram = self.histograms.pop(key, None)
+            if histogram is not None:
+                histogram.reset()
+                self.pool.append(histogram)
+
+    def recycle(self, histograms):
+        # takes back histograms given by snapshot_and_reset(), as many as the
+        # budget allows
+        with self.lock:
+            for histogram in histograms:
+                if not self.fits(self.histogram_size):
+                    break
+
+                if histogram.backend is self.backend and same_layout(histogram.struct, self.struct):
+                    histogram.reset()
+                    self.pool.append(histogram)
+
+    def record(self, key, value):
+        with self.lock:
+            self.acquire(key).record(value)
+
+    def corrected(self, key, value, interval):
+        with self.lock:
+            self.acquire(key).corrected(value, interval)
+
+    def record_repeat(self, key, value, times):
+        with self.lock:
+            self.acquire(key).record_repeat(value, times)
+
+    def record_many(self, key, values):
+        with self.lock:
+            return self.acquire(key).record_many(values)
+
+    def snapshot_and_reset(self):
+        # the histograms of every key, spilled ones included, the registry is
+        # left empty and the histograms can be given back with recycle()
+        with self.lock:
+            snapshot = self.histograms
+            spilled = self.spilled
+            self.histograms = OrderedDict()
+            self.spilled = OrderedDict()
+            self.spilled_bytes = 0
+
+        snapshot = dict(snapshot)
+        for key, encoded in spilled.items():
+            snapshot[key] = Histogram.decode(encoded, backend=self.backend)
+
+        return snapshot
+
+
+def shared_memory():
+    # imported on first use, multiprocessing is slow to import
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise Exception('multiprocessing.shared_memory is not available')
+
+    return shared_memory
+
+
+class SharedHistograms(object):
+    # Histograms whose counts live in a shared memory segment, one slot per
+    # worker process. A worker records into its slot without any IPC and
+    # collect() sums every slot from any process attached to the segment.
+    #
+    # Only the counts are shared, the min/max/total of a slot are private to
+    # the process using it and are rebuilt from the counts when needed.
+    HEADER = Struct('=qqqqqq')
+    COOKIE = 0x1c8493f0
+
+    def __init__(self, slots, lowest, highest, significant, name=None, backend=None):
+        struct = HistogramStruct()
+        if bucket_config(struct, lowest, highest, significant):
+            raise Exception('Invalid arguments')
+
+        size = self.HEADER.size + slots * struct.counts_len * ctypes.sizeof(int64)
+        memory = shared_memory().SharedMemory(name=name, create=True, size=size)
+        self.HEADER.pack_into(memory.buf, 0, self.COOKIE, lowest, highest, significant, slots, struct.counts_len)
+        self.setup(memory, backend)
+
+    @classmethod
+    def open(cls, name, backend=None):
+        shared = cls.__new__(cls)
+        shared.setup(shared_memory().SharedMemory(name=name), backend)
+        return shared
+
+    def __reduce__(self):
+        return (SharedHistograms.open, (self.name, self.backend.name))
+
+    def setup(self, memory, backend):
+        cookie, lowest, highest, significant, slots, counts_len = self.HEADER.unpack_from(memory.buf, 0)
+
+        if cookie != self.COOKIE:
+            raise Exception('{} is not a shared histogram segment'.format(memory.name))
+
+        self.memory = memory
+        self.name = memory.name
+        self.backend = get_backend(backend)
+        self.lowest = lowest
+        self.highest = highest
+        self.significant = significant
+        self.slots = slots
+        self.counts_len = counts_len
+
+    def counts(self, slot):
+        if not (0 <= slot < self.slots):
+            raise IndexError
+
+        offset = self.HEADER.size + slot * self.counts_len * ctypes.sizeof(int64)
+        return (int64 * self.counts_len).from_buffer(self.memory.buf, offset)
+
+    def slot(self, slot):
+        # the histogram a worker records into
+        struct = HistogramStruct()
+        bucket_config(struct, self.lowest, self.highest, self.significant)
+        histogram = Histogram.attach(struct, self.counts(slot), backend=self.backend)
+        reset_internal_counters(histogram.struct, histogram.counts)
+        return histogram
+
+    def collect(self, histogram=None):
+        # sums the counts of all the slots into histogram (reset first)
+        numpy = numpy_module()
+
+        if histogram is None:
+            histogram = Histogram(self.lowest, self.highest, self.significant, backend=self.backend)
+        elif histogram.struct.counts_len != self.counts_len:
+            raise Exception('the histogram bucket layout does not match the shared one')
+
+        counts = histogram.counts
+
+        if numpy is not None:
+            offset = self.HEADER.size
+            slots = numpy.frombuffer(self.memory.buf, dtype=numpy.int64, count=self.slots * self.counts_len,
+                                     offset=offset)
+            numpy.frombuffer(counts, dtype=numpy.int64)[:] = slots.reshape(self.slots, self.counts_len).sum(axis=0)
+            del slots
+        else:
+            totals = [0] * self.counts_len
+            for slot in range(self.slots):
+                slot_counts = self.counts(slot)
+                for index in range(self.counts_len):
+                    totals[index] += slot_counts[index]
+                del slot_counts
+            for index in range(self.counts_len):
+                counts[index] = totals[index]
+
+        histogram.generation += 1
+        reset_internal_counters(histogram.struct, counts)
+        return histogram
+
+    def close(self):
+        # every slot histogram must be released before closing
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+
+class LogInterval(namedtuple('LogInterval', ('tag', 'start', 'length', 'max', 'payload'))):
+    # an interval line of a histogram log, the payload is only decompressed
+    # by decode()
+    __slots__ = ()
+
+    def decode(self, backend=None):
+        return Histogram.decode(self.payload, backend=backend)
+
+
+class HistogramLogWriter(object):
+    # Writes the HdrHistogram log format (version 1.3), the interval
+    # timestamps are written relative to base_time
+    def __init__(self, output, base_time=0.0, max_value_unit_ratio=1000000.0):
+        self.output = output
+        self.base_time = base_time
+        self.max_value_unit_ratio = max_value_unit_ratio
+
+    def output_comment(self, comment):
+        self.output.write('#{}\n'.format(comment))
+
+    def output_log_format_version(self):
+        self.output_comment('[Histogram log format version 1.3]')
+
+    def output_start_time(self, start_time):
+        self.output_comment('[StartTime: {:.3f} (seconds since epoch), {}]'.format(start_time, time.ctime(start_time)))
+
+    def output_base_time(self, base_time):
+        self.output_comment('[BaseTime: {:.3f} (seconds since epoch)]'.format(base_time))
+
+    def output_legend(self):
+        self.output.write('"StartTimestamp","Interval_Length","Interval_Max","Interval_Compressed_Histogram"\n')
+
+    def output_interval_histogram(self, start, end, histogram, tag=None):
+        line = '{:.3f},{:.3f},{:.3f},{}\n'.format(
+            start - self.base_time,
+            end - start,
+            histogram.max() / self.max_value_unit_ratio,
+            histogram.encode().decode('ascii'),
+        )
+
+        if tag is not None:
+            line = 'Tag={},{}'.format(tag, line)
+
+        self.output.write(line)
+
+
+class HistogramLogReader(object):
+    # Streams the intervals of a histogram log, the lines are parsed one at a
+    # time and the filters are applied before any payload is decompressed.
+    def __init__(self, source):
+        self.source = source
+        self.start_time = None
+        self.base_time = None
+
+    def __iter__(self):
+        return self.intervals()
+
+    def intervals(self, start=None, end=None, tags=None):
+        # start and end are absolute timestamps in seconds, tags is a
+        # collection of accepted tags (None stands for the untagged intervals)
+        for line in self.source:
+            line = line.strip()
+
+            if not line or line.startswith('"StartTimestamp"'):
+                continue
+
+            if line.startswith('#'):
+                if line.startswith('#[StartTime: '):
+                    self.start_time = float(line[len('#[StartTime: '):].split()[0])
+                elif line.startswith('#[BaseTime: '):
+                    self.base_time = float(line[len('#[BaseTime: '):].split()[0])
+                continue
+
+            tag = None
+            if line.startswith('Tag='):
+                tag, line = line[len('Tag='):].split(',', 1)
+
+            if tags is not None and tag not in tags:
+                continue
+
+            interval_start, length, interval_max, payload = line.split(',')
+            interval_start = float(interval_start)
+
+            # same heuristic as the Java reader, logs without a BaseTime are
+            # relative to the StartTime when the timestamps are too small
+            if self.base_time is None:
+                year = 365 * 24 * 3600.0
+                if self.start_time is not None and interval_start < self.start_time - year:
+                    self.base_time = self.start_time
+                else:
+                    self.base_time = 0.0
+
+            interval_start += self.base_time
+
+            if start is not None and interval_start < start:
+                continue
+
+            if end is not None and interval_start > end:
+                continue
+
+            yield LogInterval(tag, interval_start, float(length), float(interval_max), payload)
+
+    def add_intervals(self, accumulator, start=None, end=None, tags=None):
+        # merges the matching intervals into accumulator, only one interval
+        # is decoded at a time
+        merged = 0
+
+        for interval in self.intervals(start, end, tags):
+            accumulator += interval.decode(backend=accumulator.backend)
+            merged += 1
+
+        return merged
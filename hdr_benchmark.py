@@ -0,0 +1,297 @@
+# -*- coding: utf8 -*-
+# Benchmarks of the recording, query, iteration, merge and serialization
+# paths, for every layout in LAYOUTS:
+#
+#     python hdr_benchmark.py [--backend NAME] [--json FILE] [--compare FILE]
+#
+# The timings are the best of --repeat runs in nanoseconds per unit of work,
+# a recorded value, a percentile query or a whole call (an iteration, a merge,
+# an encoding), the unit is part of each result's name. The sizes are bytes
+# per histogram. --json saves the results as a baseline and --compare reports
+# the change against one, exiting with 1 when a benchmark is slower than
+# --threshold times its baseline. A baseline is only compared with results of
+# the same backend and environment (numpy, python version and platform).
+# hdr_benchmark.json is the baseline of the python backend with numpy.
+import argparse
+import ctypes
+import json
+import pickle
+import platform
+import random
+import sys
+import timeit
+
+import hdr
+
+# name -> (lowest, highest, significant)
+LAYOUTS = {
+    'us-1h-2': (1, 3600 * 1000 * 1000, 2),
+    'us-1h-3': (1, 3600 * 1000 * 1000, 3),
+    'ns-1h-3': (1, 3600 * 1000 * 1000 * 1000, 3),
+    'ms-1d-4': (1, 24 * 3600 * 1000, 4),
+}
+
+# values recorded per operation by the recording benchmarks
+VALUES = 10000
+PERCENTILES = [50.0, 90.0, 99.0, 99.9, 99.99, 100.0]
+
+
+def sample(highest, count, seed=0):
+    # latency like values, log normal and capped to the layout
+    rng = random.Random(seed)
+    return [min(int(rng.lognormvariate(10, 2)), highest) for _ in range(count)]
+
+
+def populated(layout, values, backend):
+    histogram = hdr.Histogram(*layout, backend=backend)
+    histogram.record_many(values)
+    return histogram
+
+
+# Every benchmark takes a layout, its sample values and the backend, and
+# returns the operation to time, the units of work it does and their name.
+
+def bench_record(layout, values, backend):
+    record = hdr.Histogram(*layout, backend=backend).record
+
+    def run():
+        for value in values:
+            record(value)
+
+    return run, len(values), 'value'
+
+
+def bench_record_repeat(layout, values, backend):
+    record_repeat = hdr.Histogram(*layout, backend=backend).record_repeat
+
+    def run():
+        for value in values:
+            record_repeat(value, 3)
+
+    return run, len(values), 'value'
+
+
+def bench_corrected(layout, values, backend):
+    corrected = hdr.Histogram(*layout, backend=backend).corrected
+    # a few missing values per recorded one
+    interval = sorted(values)[len(values) // 2]
+
+    def run():
+        for value in values:
+            corrected(value, interval)
+
+    return run, len(values), 'value'
+
+
+def bench_record_many(layout, values, backend):
+    histogram = hdr.Histogram(*layout, backend=backend)
+    values = hdr.int64_values(values)
+
+    def run():
+        histogram.record_many(values)
+
+    return run, len(values), 'value'
+
+
+def bench_valued_at_percentile(layout, values, backend):
+    valued_at_percentile = populated(layout, values, backend).valued_at_percentile
+
+    def run():
+        for percentile in PERCENTILES:
+            valued_at_percentile(percentile)
+
+    return run, len(PERCENTILES), 'query'
+
+
+def bench_value_at_percentiles(layout, values, backend):
+    histogram = populated(layout, values, backend)
+
+    def run():
+        histogram.value_at_percentiles(PERCENTILES)
+
+    return run, 1, 'call'
+
+
+def iteration(itertype, **parameters):
+    def bench(layout, values, backend):
+        histogram = populated(layout, values, backend)
+
+        def run():
+            for _ in histogram.iter(itertype, **parameters):
+                pass
+
+        return run, 1, 'call'
+
+    bench.__name__ = 'bench_iter_{}'.format(itertype)
+    return bench
+
+
+def bench_iadd(layout, values, backend):
+    histogram = hdr.Histogram(*layout, backend=backend)
+    other = populated(layout, values, backend)
+
+    def run():
+        histogram.__iadd__(other)
+
+    return run, 1, 'call'
+
+
+def bench_encode(layout, values, backend):
+    histogram = populated(layout, values, backend)
+
+    def run():
+        histogram.encode()
+
+    return run, 1, 'call'
+
+
+def bench_decode(layout, values, backend):
+    encoded = populated(layout, values, backend).encode()
+
+    def run():
+        hdr.Histogram.decode(encoded, backend=backend)
+
+    return run, 1, 'call'
+
+
+def bench_pickle(layout, values, backend):
+    histogram = populated(layout, values, backend)
+
+    def run():
+        pickle.loads(pickle.dumps(histogram))
+
+    return run, 1, 'call'
+
+
+def bench_clone(layout, values, backend):
+    histogram = populated(layout, values, backend)
+
+    def run():
+        histogram.clone()
+
+    return run, 1, 'call'
+
+
+BENCHMARKS = [
+    bench_record,
+    bench_record_repeat,
+    bench_corrected,
+    bench_record_many,
+    bench_valued_at_percentile,
+    bench_value_at_percentiles,
+    iteration('basic'),
+    iteration('recorded'),
+    iteration('linear', units_per_bucket=100000),
+    iteration('log', value_units_first_bucket=1000, log_base=2.0),
+    iteration('percentile', ticks_per_half_distance=5),
+    bench_iadd,
+    bench_encode,
+    bench_decode,
+    bench_pickle,
+    bench_clone,
+]
+
+
+def sizes(layout, values, backend):
+    # bytes of the struct and counts, and of the encoded form of the sample
+    histogram = populated(layout, values, backend)
+    memory = ctypes.sizeof(hdr.HistogramStruct) + histogram.struct.counts_len * histogram.word_size
+    return {'memory_bytes': memory, 'encoded_bytes': len(histogram.encode())}
+
+
+def environment():
+    # what the timings depend on besides the backend
+    return {
+        'numpy': hdr.numpy_module() is not None,
+        'python': '{} {}.{}'.format(platform.python_implementation(), *sys.version_info[:2]),
+        'platform': '{} {}'.format(platform.system(), platform.machine()),
+    }
+
+
+def run(backend=None, layouts=None, benchmarks=None, repeat=5, number=None, values=VALUES):
+    # {layout: {benchmark_ns_per_unit: nanoseconds, ...sizes}}, number
+    # defaults to what timeit's autorange picks
+    backend = hdr.get_backend(backend).name
+    results = {}
+
+    for name, layout in sorted((layouts or LAYOUTS).items()):
+        sample_values = sample(layout[1], values)
+        result = results[name] = sizes(layout, sample_values, backend)
+
+        for bench in benchmarks or BENCHMARKS:
+            operation, units, unit = bench(layout, sample_values, backend)
+            timer = timeit.Timer(operation)
+            calls = number or timer.autorange()[0]
+            best = min(timer.repeat(repeat, calls))
+            name = '{}_ns_per_{}'.format(bench.__name__[len('bench_'):], unit)
+            result[name] = best / calls / units * 1e9
+
+    return {'backend': backend, 'environment': environment(), 'results': results}
+
+
+def report(current, baseline=None, threshold=None, output=sys.stdout):
+    # prints the results, and their change against a baseline of the same
+    # backend and environment, returns the benchmarks slower than threshold
+    # times their baseline
+    regressions = []
+    previous = {}
+
+    output.write('backend: {}\n'.format(current['backend']))
+    output.write('environment: {}\n'.format(json.dumps(current['environment'], sort_keys=True)))
+    if baseline and baseline['backend'] != current['backend']:
+        output.write('the baseline is of the {} backend, it is not compared\n'.format(baseline['backend']))
+    elif baseline and baseline.get('environment') != current['environment']:
+        output.write('the baseline is of another environment {}, it is not compared\n'.format(
+            json.dumps(baseline.get('environment'), sort_keys=True)))
+    elif baseline:
+        previous = baseline['results']
+
+    for layout, result in sorted(current['results'].items()):
+        output.write('\n{}\n'.format(layout))
+
+        for name, value in sorted(result.items()):
+            timing = '_ns_per_' in name
+            line = '    {:<36} {:>14.1f}'.format(name, value)
+
+            before = previous.get(layout, {}).get(name)
+            if before:
+                ratio = value / before
+                line += '  {:+.1%}'.format(ratio - 1)
+                if threshold is not None and timing and ratio > threshold:
+                    regressions.append((layout, name, ratio))
+                    line += '  REGRESSION'
+
+            output.write(line + '\n')
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='hdr.py benchmarks')
+    parser.add_argument('--backend', help='the backend to benchmark, defaults to the preferred one')
+    parser.add_argument('--layout', action='append', choices=sorted(LAYOUTS), help='a layout to benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='file to save the results to, as a baseline')
+    parser.add_argument('--compare', help='baseline to compare the results with')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown reported as a regression')
+    args = parser.parse_args(argv)
+
+    layouts = {name: LAYOUTS[name] for name in args.layout} if args.layout else None
+    current = run(args.backend, layouts, repeat=args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as handler:
+            baseline = json.load(handler)
+
+    regressions = report(current, baseline, args.threshold)
+
+    if args.json:
+        with open(args.json, 'w') as handler:
+            json.dump(current, handler, indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
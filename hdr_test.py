@@ -1,7 +1,24 @@
 # -*- coding: utf8 -*-
+from array import array
+import copy
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import subprocess
+import sys
+import threading
+
 import hdr
+import hdr_benchmark
 import pytest
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
 # histogram __init__ values
 LOWEST = 1
 SCALED_LOWEST = 1000
@@ -15,6 +32,13 @@ LOOPS = 10000
 VALUE = 1000
 HIGHEST_VALUE = 100000000
 
+# seconds `import hdr` may take, numpy is imported on first use
+IMPORT_BUDGET = 0.25
+
+# the C library is loaded by the first histogram, the skipif conditions need
+# it earlier
+hdr.get_backend()
+
 
 @pytest.fixture
 def simple():
@@ -188,6 +212,52 @@ def test_linear_values(simple, corrected):
     assert total == 20000, 'Should of met 20000 counts'
 
 
+def test_logarithmic_values(simple, corrected):
+    iterable = simple.iter('log', value_units_first_bucket=10000, log_base=2.0)
+
+    bucket_count = next(iterable)
+    assert bucket_count.count == 10000, 'Count at 0 is not 10000'
+
+    for iteration, bucket_count in zip(range(1, 14), iterable):
+        assert bucket_count.count == 0, 'Count at {} is not 0'.format(iteration)
+
+    # iteration 14
+    bucket_count = next(iterable)
+    assert bucket_count.count == 1, 'Count at 14 is not 1'
+
+    with pytest.raises(StopIteration):
+        next(iterable)
+
+    iterable = corrected.iter('log', value_units_first_bucket=10000, log_base=2.0)
+    bucket_count = next(iterable)
+    assert bucket_count.count == 10001, 'Count at 0 is not 10001'
+
+    pos = 1
+    total = bucket_count.count
+    for bucket_count in iterable:
+        total += bucket_count.count
+        pos += 1
+
+    assert pos == 15, 'Should of met 15 values'
+    assert total == 20000, 'Should of met 20000 counts'
+
+
+def test_percentile_iteration(simple, corrected):
+    for histogram in (simple, corrected):
+        rows = list(histogram.iter('percentile', ticks_per_half_distance=5))
+
+        assert rows[0].percentile == 0.0
+        assert rows[-1].percentile == 100.0
+        assert rows[-1].value == histogram.max()
+
+        assert rows == sorted(rows)
+
+        for row in rows:
+            if row.percentile <= 99.0:
+                expected = histogram.valued_at_percentile(row.percentile)
+                assert histogram.lowest_equivalent(row.value) == histogram.lowest_equivalent(expected)
+
+
 def test_reset(simple, corrected):
     assert simple.valued_at_percentile(99.0) != 0
     assert corrected.valued_at_percentile(99.0) != 0
@@ -221,3 +291,794 @@ def test_out_of_range_values():
 
     with pytest.raises(Exception):
         histogram.record(32768)
+
+
+def test_record_many():
+    values = [VALUE] * LOOPS + [HIGHEST_VALUE]
+    buffers = [
+        values,
+        iter(values),
+        array('q', values),
+        memoryview(array('q', values)),
+        array('q', values).tobytes(),
+    ]
+
+    for buffer in buffers:
+        histogram = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+        assert histogram.record_many(buffer) == 0
+        assert histogram.total() == 10001
+        assert histogram.min() == 1000
+        assert histogram.lowest_equivalent(histogram.max()) == histogram.lowest_equivalent(HIGHEST_VALUE)
+
+    # narrow and strided buffers are converted value by value
+    small = list(range(1, 9))
+    buffers = [array('b', small), memoryview(array('q', [value for value in small for _ in (0, 1)]))[::2]]
+    try:
+        import numpy
+    except ImportError:
+        pass
+    else:
+        buffers += [numpy.array(small, dtype=numpy.int8), numpy.repeat(numpy.array(small), 2)[::2]]
+
+    for buffer in buffers:
+        histogram = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+        assert histogram.record_many(buffer) == 0
+        assert histogram.total() == 8
+        assert (histogram.min(), histogram.max()) == (1, 8)
+
+
+def test_record_many_corrected(corrected):
+    histogram = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+
+    assert histogram.record_many_corrected([VALUE] * LOOPS + [HIGHEST_VALUE], INTERVAL) == 0
+    assert histogram.total() == corrected.total()
+    assert histogram.valued_at_percentile(90.0) == corrected.valued_at_percentile(90.0)
+
+
+def test_record_many_out_of_range():
+    histogram = hdr.Histogram(1, 1000, 4)
+
+    assert histogram.record_many([1, 32767, 32768, -1, 10, 1 << 40]) == 3
+    assert histogram.total() == 3
+
+
+def test_backend_selection():
+    assert hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT).backend is hdr.get_backend()
+    assert hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, backend='python').backend.name == 'python'
+
+    with pytest.raises(Exception):
+        hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, backend='missing')
+
+
+def test_lazy_loading():
+    script = """
+import json, sys, time
+
+start = time.time()
+import hdr
+elapsed = time.time() - start
+
+deferred = [
+    name for name in ('ctypes.util', 'concurrent.futures', 'multiprocessing', 'numpy') if name in sys.modules
+]
+loaded = hdr.hdrlib is not None
+
+# the native backend does not need the C library
+default = hdr.Histogram(1, 1000, 3).backend.name
+attempted = hdr.load_error is not None
+
+try:
+    hdr.Histogram(1, 1000, 3, backend='c')
+    error = None
+except Exception as e:
+    error = str(e)
+
+print(json.dumps([elapsed, deferred, loaded, default, attempted, error]))
+"""
+    env = dict(os.environ, HDR_HISTOGRAM_LIBRARY='/missing/libhdr_histogram.so')
+    output = subprocess.check_output([sys.executable, '-c', script], env=env, cwd=os.path.dirname(hdr.__file__))
+    elapsed, deferred, loaded, default, attempted, error = json.loads(output.decode('utf8'))
+
+    assert elapsed < IMPORT_BUDGET
+    assert deferred == []
+    assert not loaded
+    assert default in ('native', 'python')
+    assert attempted == (default == 'python')
+    assert '/missing/libhdr_histogram.so' in error
+
+    with pytest.raises(Exception):
+        hdr.load('/missing/libhdr_histogram.so')
+
+
+@pytest.mark.skipif('c' not in hdr.backends, reason='libhdr_histogram is not available')
+def test_backends_are_equivalent():
+    histograms = []
+    for backend in ('c', 'python'):
+        histogram = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, backend=backend)
+        for i in range(LOOPS):
+            histogram.corrected(VALUE + i * 7, INTERVAL)
+        histograms.append(histogram)
+
+    c, python = histograms
+    assert c.struct.counts_len == python.struct.counts_len
+    assert c.total() == python.total()
+    assert c.min() == python.min()
+    assert c.max() == python.max()
+    assert c.mean() == python.mean()
+    assert c.stddev() == python.stddev()
+
+    for percentile in (0.0, 30.0, 50.0, 90.0, 99.0, 99.999, 100.0):
+        assert c.valued_at_percentile(percentile) == python.valued_at_percentile(percentile)
+
+    assert list(c.iter('recorded')) == list(python.iter('recorded'))
+    assert list(c.iter('linear', units_per_bucket=10000)) == list(python.iter('linear', units_per_bucket=10000))
+
+    log = dict(value_units_first_bucket=10000, log_base=2.0)
+    assert list(c.iter('log', **log)) == list(python.iter('log', **log))
+    percentile = dict(ticks_per_half_distance=5)
+    assert list(c.iter('percentile', **percentile)) == list(python.iter('percentile', **percentile))
+
+
+@pytest.mark.skipif('native' not in hdr.backends, reason='the _hdr extension is not built')
+def test_native_backend():
+    values = [VALUE + i * 7 for i in range(LOOPS)] + [HIGHEST_VALUE, 0, -1, HIGHEST * 2]
+
+    histograms = []
+    for backend in ('native', 'python'):
+        histogram = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, backend=backend)
+        assert histogram.record_many(values) == 2
+        assert histogram.record_many_corrected(values, INTERVAL) == 2
+        histogram.record_repeat(VALUE, 3)
+        histogram.corrected(HIGHEST_VALUE, INTERVAL)
+        histograms.append(histogram)
+
+    native, python = histograms
+    assert native.backend is hdr.get_backend()
+    assert list(native.counts) == list(python.counts)
+    assert native.total() == python.total()
+    assert native.min() == python.min()
+    assert native.max() == python.max()
+    assert native.mean() == pytest.approx(python.mean())
+    assert native.stddev() == pytest.approx(python.stddev())
+    assert native.lowest_equivalent(HIGHEST_VALUE) == python.lowest_equivalent(HIGHEST_VALUE)
+
+    for percentile in (0.0, 30.0, 50.0, 90.0, 99.0, 99.999, 100.0):
+        assert native.valued_at_percentile(percentile) == python.valued_at_percentile(percentile)
+
+    with pytest.raises(Exception):
+        hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, backend='native', word_size=4)
+
+
+def test_counts_view(simple):
+    counts = simple.counts
+
+    assert len(counts) == len(simple) == simple.struct.counts_len
+    assert sum(counts) == simple.total()
+
+    index = simple.index_for(VALUE)
+    assert counts[index] == simple[index] == 10000
+    assert simple.range_at(index) == (VALUE, VALUE, 10000)
+
+    starts, ends = simple.value_ranges()
+    assert starts[index] <= VALUE <= ends[index]
+    assert starts[simple.index_for(HIGHEST_VALUE)] == simple.lowest_equivalent(HIGHEST_VALUE)
+
+    # the view aliases the histogram's memory
+    simple.record(VALUE)
+    assert counts[index] == 10001
+
+    with pytest.raises(IndexError):
+        simple[len(simple)]
+
+
+def test_value_at_percentiles(simple, corrected):
+    percentiles = [99.999, 50.0, 75.0, 0.0, 99.0, 100.0, 90.0]
+
+    for histogram in (simple, corrected):
+        expected = [
+            hdr.Percentile(percentile, histogram.valued_at_percentile(percentile))
+            for percentile in percentiles
+        ]
+        assert histogram.value_at_percentiles(percentiles) == expected
+
+    simple.reset()
+    assert simple.value_at_percentiles([50.0, 99.0]) == [(50.0, 0), (99.0, 0)]
+
+
+def test_corrected_copy(simple):
+    # the buckets are corrected from their lowest value
+    highest_start = simple.lowest_equivalent(HIGHEST_VALUE)
+    expected = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    for i in range(LOOPS):
+        expected.corrected(VALUE, INTERVAL)
+    expected.corrected(highest_start, INTERVAL)
+
+    copy = simple.corrected_copy(INTERVAL)
+    assert list(copy.counts) == list(expected.counts)
+    assert (copy.total(), copy.min(), copy.max()) == (expected.total(), expected.min(), expected.max())
+
+    # the original is left as is
+    assert simple.total() == LOOPS + 1
+    assert list(simple.corrected_copy(0).counts) == list(simple.counts)
+
+    # the batched correction matches correcting the values one by one
+    values = [VALUE + i * 7 for i in range(LOOPS)] + [HIGHEST_VALUE, INTERVAL * 2 + 1]
+    one_by_one = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    for value in values:
+        one_by_one.corrected(value, INTERVAL)
+
+    batched = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    assert batched.record_many_corrected(values + [-1], INTERVAL) == 1
+    assert list(batched.counts) == list(one_by_one.counts)
+    assert (batched.total(), batched.min(), batched.max()) == (one_by_one.total(), one_by_one.min(), one_by_one.max())
+
+
+def test_freeze(simple, corrected):
+    percentiles = [0.0, 30.0, 50.0, 90.0, 99.0, 99.999, 100.0]
+
+    for histogram in (simple, corrected):
+        frozen = histogram.freeze()
+        assert frozen.value_at_percentiles(percentiles) == histogram.value_at_percentiles(percentiles)
+
+    frozen = simple.freeze()
+    assert frozen.rank(VALUE - 1) == 0
+    assert frozen.rank(VALUE) == 10000
+    assert frozen.rank(HIGHEST_VALUE) == 10001
+    assert frozen.fraction_at_or_below(VALUE) == 10000 / 10001.0
+
+    # the index follows the source histogram
+    simple.record(HIGHEST_VALUE)
+    assert frozen.rank(HIGHEST_VALUE) == 10002
+
+    simple.reset()
+    simple.record(VALUE)
+    assert frozen.rank(VALUE) == 1
+    assert frozen.valued_at_percentile(99.0) == VALUE
+
+
+def test_to_arrays(simple, corrected):
+    for histogram in (simple, corrected):
+        for itertype, units in (('basic', None), ('recorded', None), ('linear', 10000)):
+            columns = histogram.to_arrays(itertype, units_per_bucket=units)
+            rows = list(histogram.iter(itertype, units_per_bucket=units))
+            assert [tuple(int(value) for value in row) for row in zip(*columns)] == [tuple(row) for row in rows]
+
+        starts, ends, counts = histogram.to_arrays('log', value_units_first_bucket=10000, log_base=2.0)
+        assert sum(counts) == histogram.total()
+
+        percentiles, values = histogram.to_arrays('percentile', ticks_per_half_distance=5)
+        assert percentiles[0] == 0.0 and percentiles[-1] == 100.0
+        assert values[-1] == histogram.max()
+
+    # with lowest > 1 the first bucket covers several units
+    zero = hdr.Histogram(SCALED_LOWEST, HIGHEST, SIGNIFICANT)
+    zero.record(0)
+    log = dict(value_units_first_bucket=1, log_base=2.0)
+    for itertype, parameters in (('linear', dict(units_per_bucket=1)), ('log', log)):
+        columns = zero.to_arrays(itertype, **parameters)
+        rows = list(zero.iter(itertype, **parameters))
+        assert [tuple(int(value) for value in row) for row in zip(*columns)] == [tuple(row) for row in rows]
+
+    empty = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    assert list(empty.to_arrays('percentile', ticks_per_half_distance=5).value) == [0]
+    assert len(empty.to_arrays('recorded').count) == 0
+
+    with pytest.raises(Exception):
+        simple.to_arrays('log', value_units_first_bucket=10000, log_base=1.0)
+
+
+def test_encode_decode(simple, corrected):
+    for histogram in (simple, corrected, hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)):
+        decoded = hdr.Histogram.decode(histogram.encode())
+
+        assert list(decoded.counts) == list(histogram.counts)
+        assert decoded.total() == histogram.total()
+        assert decoded.min() == histogram.min()
+        assert decoded.max() == histogram.max()
+        assert decoded.struct.significant_figures == SIGNIFICANT
+        assert decoded.struct.highest_trackable_value == HIGHEST
+
+
+def test_decode_interoperability(simple):
+    # encoded by HdrHistogram_py with the same values as the simple fixture
+    encoded = b'HISTFAAAACl4nJNpmSzMwMDAyQABzFCaEURcm7yEwf4DROA8/4I5jNM7mJgAjtkHzg=='
+    decoded = hdr.Histogram.decode(encoded)
+
+    assert list(decoded.counts) == list(simple.counts)
+    assert decoded.valued_at_percentile(99.999) == simple.valued_at_percentile(99.999)
+
+    with pytest.raises(Exception):
+        hdr.Histogram.decode(simple.encode()[:8] + b'AAAA')
+
+
+def test_merge():
+    histograms = []
+    for host in range(20):
+        histogram = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+        histogram.record_many([VALUE + host * 13 + i for i in range(100)])
+        histograms.append(histogram)
+
+    expected = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    for histogram in histograms:
+        expected += histogram
+
+    for workers in (1, 4):
+        merged = hdr.merge(histograms, workers=workers)
+        assert list(merged.counts) == list(expected.counts)
+        assert (merged.total(), merged.min(), merged.max()) == (expected.total(), expected.min(), expected.max())
+
+    # a different layout is folded value by value
+    other = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT + 1)
+    other.record(HIGHEST_VALUE)
+    merged = hdr.merge(histograms + [other], workers=4)
+    assert merged.total() == expected.total() + 1
+    assert merged.max() == expected.range_at(expected.index_for(HIGHEST_VALUE)).end
+
+    with pytest.raises(Exception):
+        hdr.merge([])
+
+
+def test_pickle(corrected):
+    for clone in (pickle.loads(pickle.dumps(corrected)), copy.copy(corrected), corrected.clone()):
+        assert clone.backend is corrected.backend
+        assert list(clone.counts) == list(corrected.counts)
+        assert (clone.total(), clone.min(), clone.max()) == (corrected.total(), corrected.min(), corrected.max())
+        assert clone.valued_at_percentile(99.0) == corrected.valued_at_percentile(99.0)
+
+        clone.record(VALUE)
+        assert clone.total() == corrected.total() + 1
+
+    assert len(pickle.dumps(corrected)) < corrected.struct.counts_len
+    assert pickle.loads(pickle.dumps(hdr.Histogram(LOWEST, None, SIGNIFICANT, auto_resize=True))).auto_resize
+    assert copy.deepcopy([corrected])[0].struct.max_value == corrected.struct.max_value
+
+    packed = hdr.PackedHistogram.from_histogram(corrected)
+    assert list(pickle.loads(pickle.dumps(packed)).indexes) == list(packed.indexes)
+
+    double = hdr.DoubleHistogram(1000, SIGNIFICANT)
+    double.record(0.5)
+    assert pickle.loads(pickle.dumps(double)).max() == double.max()
+
+
+def test_subtract():
+    cumulative = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    cumulative.record_many([VALUE, VALUE * 2, HIGHEST_VALUE])
+    previous = cumulative.delta(hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT))
+    assert list(previous.counts) == list(cumulative.counts)
+
+    cumulative.record_many([VALUE * 2, VALUE * 3])
+    delta = cumulative.delta(previous)
+
+    expected = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    expected.record_many([VALUE * 2, VALUE * 3])
+    assert list(delta.counts) == list(expected.counts)
+    assert (delta.total(), delta.min(), delta.max()) == (expected.total(), expected.min(), expected.max())
+    assert cumulative.total() == 5
+
+    cumulative -= previous
+    assert list(cumulative.counts) == list(expected.counts)
+    assert cumulative.max() == expected.max()
+
+    cumulative -= expected
+    assert (cumulative.total(), cumulative.min(), cumulative.max()) == (0, hdr.INT64_MAX, 0)
+
+    with pytest.raises(Exception):
+        cumulative.subtract(expected)
+
+    with pytest.raises(Exception):
+        cumulative.subtract(hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT + 1))
+
+    # the sparse counts of a packed histogram are expanded
+    cumulative.record_repeat(0, 3)
+    cumulative.record_repeat(5000, 10)
+    packed = hdr.PackedHistogram(LOWEST, HIGHEST, SIGNIFICANT)
+    packed.record_repeat(5000, 2)
+    cumulative -= packed
+    assert (cumulative.total(), cumulative[0], cumulative[cumulative.index_for(5000)]) == (11, 3, 8)
+
+
+def test_sliding_window():
+    now = [0.0]
+    window = hdr.SlidingWindowHistogram(60, 6, LOWEST, HIGHEST, SIGNIFICANT, clock=lambda: now[0])
+
+    for second in range(60):
+        now[0] = second
+        window.record(VALUE * (second + 1))
+
+    assert window.total() == 60
+    assert window.min() == VALUE
+    assert window.max() == window.histogram().range_at(window.histogram().index_for(VALUE * 60)).end
+
+    # the first 10 seconds left the window
+    now[0] = 65
+    window.record_many([HIGHEST_VALUE, -1])
+    expected = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    expected.record_many([VALUE * (second + 1) for second in range(10, 60)] + [HIGHEST_VALUE])
+
+    assert list(window.histogram().counts) == list(expected.counts)
+    assert (window.total(), window.min(), window.max()) == (expected.total(), expected.min(), expected.max())
+    assert window.valued_at_percentile(50.0) == expected.valued_at_percentile(50.0)
+    assert window.mean() == expected.mean()
+
+    # only the value recorded at 65 is left
+    now[0] = 119
+    assert window.total() == 1
+    assert window.min() == expected.lowest_equivalent(HIGHEST_VALUE)
+
+    now[0] = 1000
+    assert window.total() == 0
+    assert window.max() == 0
+
+    now[0] = 900
+    with pytest.raises(Exception):
+        window.record(VALUE)
+
+    with pytest.raises(Exception):
+        hdr.SlidingWindowHistogram(0, 6, LOWEST, HIGHEST, SIGNIFICANT)
+
+
+def test_registry():
+    size = hdr.HistogramRegistry(1 << 30, LOWEST, HIGHEST, SIGNIFICANT).histogram_size
+    budget = size * 2 + 200
+    registry = hdr.HistogramRegistry(budget, LOWEST, HIGHEST, SIGNIFICANT, spill=True)
+
+    registry.record(('api', 200), VALUE)
+    registry.record_many(('api', 500), [VALUE, HIGHEST_VALUE])
+    second = registry.get(('api', 500))
+    registry.get(('api', 200))
+    assert registry.memory() == size * 2
+
+    # ('api', 500) is the least recently used, it is spilled and its
+    # histogram is reused for the new key
+    registry.record_repeat(('db', 200), VALUE, 3)
+    assert registry.get(('db', 200)) is second and second.total() == 3
+    assert ('api', 500) in registry and len(registry) == 3
+    assert size * 2 < registry.memory() <= budget
+
+    restored = registry.get(('api', 500))
+    assert restored.total() == 2
+    assert restored.max() == restored.range_at(restored.index_for(HIGHEST_VALUE)).end
+
+    snapshot = registry.snapshot_and_reset()
+    assert sorted(snapshot) == [('api', 200), ('api', 500), ('db', 200)]
+    assert [snapshot[key].total() for key in sorted(snapshot)] == [1, 2, 3]
+    assert len(registry) == 0 and registry.memory() == 0
+
+    registry.recycle(snapshot.values())
+    assert len(registry.pool) == 2 and registry.memory() == size * 2
+    assert registry.get('next').total() == 0
+    assert registry.get('next') in snapshot.values()
+
+    # the spilled keys count against the budget, the oldest are dropped
+    for key in range(200):
+        registry.record(key, VALUE + key)
+        assert registry.memory() <= budget
+
+    assert 0 < len(registry.spilled) < 198
+    assert 0 not in registry and 199 in registry
+    assert registry.get(198).total() == 1
+
+    with pytest.raises(Exception):
+        hdr.HistogramRegistry(size - 1, LOWEST, HIGHEST, SIGNIFICANT)
+
+
+def test_auto_resize():
+    histogram = hdr.Histogram(LOWEST, None, SIGNIFICANT, auto_resize=True)
+    fixed = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    initial = len(histogram)
+
+    for value in (VALUE, VALUE * 1000, HIGHEST_VALUE):
+        histogram.record(value)
+        fixed.record(value)
+
+    assert initial < len(histogram) < len(fixed)
+    assert list(histogram.counts) == list(fixed.counts)[:len(histogram)]
+    assert (histogram.min(), histogram.max(), histogram.total()) == (fixed.min(), fixed.max(), fixed.total())
+
+    counts = histogram.counts
+    assert histogram.record_many([VALUE, HIGHEST * 10]) == 0
+    histogram.corrected(HIGHEST * 20, HIGHEST)
+    histogram.record_repeat(HIGHEST * 40, 3)
+    assert histogram.total() == 3 + 2 + 20 + 3
+    assert histogram.max() == histogram.range_at(histogram.index_for(HIGHEST * 40)).end
+
+    # the views taken before a resize keep the old buffer alive
+    assert counts[histogram.index_for(VALUE)] == 1
+    assert histogram.counts[histogram.index_for(VALUE)] == 2
+
+    other = hdr.Histogram(LOWEST, HIGHEST * 100, SIGNIFICANT)
+    other.record(HIGHEST * 90)
+    histogram += other
+    assert histogram.max() == other.max()
+
+    with pytest.raises(Exception):
+        histogram.record(-1)
+
+    with pytest.raises(Exception):
+        fixed.record(HIGHEST * 10)
+
+
+def test_packed_histogram(simple, corrected):
+    for histogram in (simple, corrected):
+        packed = hdr.PackedHistogram.from_histogram(histogram)
+        assert len(packed.indexes) == sum(1 for count in histogram.counts if count)
+
+        for method in ('total', 'min', 'max', 'mean', 'stddev'):
+            assert getattr(packed, method)() == getattr(histogram, method)()
+
+        percentiles = [0.0, 30.0, 50.0, 90.0, 99.0, 99.999, 100.0]
+        assert packed.value_at_percentiles(percentiles) == histogram.value_at_percentiles(percentiles)
+        assert list(packed.iter('recorded')) == list(histogram.iter('recorded'))
+        linear = dict(units_per_bucket=10000)
+        assert list(packed.iter('linear', **linear)) == list(histogram.iter('linear', **linear))
+        assert list(packed.to_histogram().counts) == list(histogram.counts)
+        decoded = hdr.PackedHistogram.decode(packed.encode())
+        assert decoded.value_at_percentiles(percentiles) == packed.value_at_percentiles(percentiles)
+
+    packed = hdr.PackedHistogram(LOWEST, HIGHEST, SIGNIFICANT)
+    for i in range(LOOPS):
+        packed.corrected(VALUE, INTERVAL)
+    packed.corrected(HIGHEST_VALUE, INTERVAL)
+    assert list(packed.to_histogram().counts) == list(corrected.counts)
+    assert packed[corrected.index_for(VALUE)] == LOOPS
+
+    # merging with dense histograms goes both ways
+    packed += simple
+    dense = packed.to_histogram()
+    dense += simple
+    assert packed.total() == corrected.total() + simple.total()
+    assert dense.total() == packed.total() + simple.total()
+
+    dense = simple.clone()
+    dense += packed
+    assert list(dense.counts) == list(hdr.merge([simple, packed]).counts)
+    assert list(dense.counts) == list(hdr.merge([packed, simple], workers=2).counts)
+    assert dense.total() == packed.total() + simple.total()
+    assert dense.max() == packed.max()
+
+    with pytest.raises(Exception):
+        packed.record(HIGHEST * 10)
+
+
+def test_word_size_default_backend():
+    histogram = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, word_size=2)
+    assert histogram.word_size == 2
+    assert histogram.backend.name == 'python'
+
+    histogram.record_repeat(VALUE, 40000)
+    assert histogram.word_size == 4
+    assert histogram.total() == 40000
+
+    assert hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT).backend is hdr.get_backend()
+
+
+def test_word_size():
+    histogram = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, backend='python', word_size=2)
+    assert histogram.word_size == 2
+    assert histogram.counts.itemsize == 2
+
+    histogram.record_repeat(VALUE, 32767)
+    counts = histogram.counts
+
+    # overflowing the 2 bytes count promotes to 4 bytes
+    histogram.record(VALUE)
+    assert histogram.word_size == 4
+    assert histogram[histogram.index_for(VALUE)] == 32768
+    assert counts[histogram.index_for(VALUE)] == 32767
+
+    assert histogram.record_many([VALUE] * 10 + [HIGHEST_VALUE]) == 0
+    histogram.corrected(HIGHEST_VALUE, INTERVAL)
+    assert histogram.total() == 32768 + 11 + 10000
+
+    # mergeable with 8 bytes histograms both ways
+    wide = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, backend='python')
+    wide.record_repeat(VALUE, 1 << 40)
+    wide += histogram
+    assert wide[wide.index_for(VALUE)] == (1 << 40) + 32778
+
+    histogram += wide
+    assert histogram.word_size == 8
+    assert histogram[histogram.index_for(VALUE)] == (1 << 40) + 2 * 32778
+    assert hdr.merge([histogram, wide]).total() == histogram.total() + wide.total()
+
+    narrow = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, backend='python', word_size=4)
+    narrow.promote()
+    assert narrow.word_size == 8
+
+    with pytest.raises(OverflowError):
+        narrow.record_repeat(VALUE, 1 << 64)
+
+    with pytest.raises(Exception):
+        hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT, word_size=3)
+
+
+def test_double_histogram():
+    histogram = hdr.DoubleHistogram(100000000, SIGNIFICANT)
+    values = [VALUE / 1000000.0 + i * 0.0000001 for i in range(LOOPS)] + [HIGHEST_VALUE / 1000000.0]
+
+    for value in values:
+        histogram.record(value)
+
+    assert histogram.total() == LOOPS + 1
+    assert abs(histogram.min() - values[0]) < values[0] * 0.001
+    assert abs(histogram.max() - values[-1]) < values[-1] * 0.001
+    assert abs(histogram.valued_at_percentile(50.0) - values[LOOPS // 2]) < values[LOOPS // 2] * 0.001
+    assert histogram.histogram.struct.conversion_ratio == 1.0 / histogram.ratio
+
+    # the batch is converted in bulk and matches the values recorded one by one
+    batched = hdr.DoubleHistogram(100000000, SIGNIFICANT)
+    assert batched.record_many(values + [-1.0]) == 1
+    assert list(batched.histogram.counts) == list(histogram.histogram.counts)
+
+    # smaller values shift the range down
+    histogram.record(values[0] / 100)
+    assert abs(histogram.min() - values[0] / 100) < values[0] / 100 * 0.001
+    assert abs(histogram.valued_at_percentile(50.0) - values[LOOPS // 2]) < values[LOOPS // 2] * 0.001
+
+    with pytest.raises(Exception):
+        histogram.record(values[0] * 1000000000)
+
+    decoded = hdr.DoubleHistogram.decode(histogram.encode())
+    assert decoded.value_at_percentiles([50.0, 99.0]) == histogram.value_at_percentiles([50.0, 99.0])
+
+    decoded += batched
+    assert decoded.total() == histogram.total() + batched.total()
+
+    # a batch spanning too much keeps the part that fits with the recorded
+    # values, the rest is dropped
+    spread = hdr.DoubleHistogram(1000, SIGNIFICANT)
+    spread.record(1.0)
+    assert spread.record_many([0.000001, 1.0]) == 1
+    assert spread.total() == 2
+    assert spread.min() == 1.0
+
+    spread = hdr.DoubleHistogram(1000, SIGNIFICANT)
+    assert spread.record_many([0.000001, 0.000002, 0.000003, 1.0, 5.0]) == 2
+    assert spread.total() == 3
+    assert spread.max() < 0.00001
+
+
+def test_histogram_log(simple, corrected):
+    output = io.StringIO()
+    writer = hdr.HistogramLogWriter(output, base_time=1000.0)
+    writer.output_log_format_version()
+    writer.output_start_time(1000.0)
+    writer.output_base_time(1000.0)
+    writer.output_legend()
+    writer.output_interval_histogram(1000.0, 1001.0, simple)
+    writer.output_interval_histogram(1001.0, 1002.0, corrected, tag='corrected')
+    writer.output_interval_histogram(1002.0, 1003.0, simple)
+
+    reader = hdr.HistogramLogReader(io.StringIO(output.getvalue()))
+    intervals = list(reader)
+    assert [(interval.tag, interval.start) for interval in intervals] == [
+        (None, 1000.0),
+        ('corrected', 1001.0),
+        (None, 1002.0),
+    ]
+    assert intervals[1].decode().total() == corrected.total()
+
+    reader = hdr.HistogramLogReader(io.StringIO(output.getvalue()))
+    assert [interval.start for interval in reader.intervals(start=1000.5, tags=[None])] == [1002.0]
+
+    accumulator = hdr.Histogram(LOWEST, HIGHEST, SIGNIFICANT)
+    reader = hdr.HistogramLogReader(io.StringIO(output.getvalue()))
+    assert reader.add_intervals(accumulator, end=1001.5) == 2
+    assert accumulator.total() == simple.total() + corrected.total()
+
+
+def test_recorder():
+    recorder = hdr.Recorder(LOWEST, HIGHEST, SIGNIFICANT)
+
+    def worker():
+        for i in range(LOOPS):
+            recorder.record(VALUE)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+
+    recorded = 0
+    while any(thread.is_alive() for thread in threads):
+        recorded += recorder.get_interval_histogram().total()
+
+    for thread in threads:
+        thread.join()
+
+    recorder.record(HIGHEST_VALUE)
+    interval = recorder.get_interval_histogram()
+    assert recorded + interval.total() == 4 * LOOPS + 1
+    assert interval.lowest_equivalent(interval.max()) == interval.lowest_equivalent(HIGHEST_VALUE)
+
+    assert recorder.get_interval_histogram(interval).total() == 0
+    assert len(recorder.shards) == 1
+
+
+def record_into_slot(shared, slot):
+    histogram = shared.slot(slot)
+    histogram.record_many([VALUE * (slot + 1)] * LOOPS)
+
+
+@pytest.mark.skipif(shared_memory is None, reason='multiprocessing.shared_memory is not available')
+def test_shared_histograms():
+    shared = hdr.SharedHistograms(3, LOWEST, HIGHEST, SIGNIFICANT)
+    try:
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=record_into_slot, args=(shared, slot)) for slot in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        histogram = shared.collect()
+        assert histogram.total() == 3 * LOOPS
+        assert histogram.min() == VALUE
+        assert histogram.lowest_equivalent(histogram.max()) == histogram.lowest_equivalent(3 * VALUE)
+
+        slot = shared.slot(1)
+        assert slot.total() == LOOPS
+        slot.record(HIGHEST_VALUE)
+        del slot
+
+        assert shared.collect(histogram).total() == 3 * LOOPS + 1
+    finally:
+        shared.close()
+        shared.unlink()
+
+
+def test_open_mmap(tmp_path):
+    path = str(tmp_path / 'histogram')
+
+    histogram = hdr.Histogram.open_mmap(path, LOWEST, HIGHEST, SIGNIFICANT)
+    histogram.record_many([VALUE] * LOOPS)
+    histogram.record(HIGHEST_VALUE)
+    histogram.flush()
+    expected = histogram.value_at_percentiles([50.0, 99.999])
+    del histogram
+
+    histogram = hdr.Histogram.open_mmap(path)
+    assert histogram.total() == 10001
+    assert histogram.min() == VALUE
+    assert histogram.value_at_percentiles([50.0, 99.999]) == expected
+
+    histogram.record(VALUE)
+    del histogram
+    assert hdr.Histogram.open_mmap(path, LOWEST, HIGHEST, SIGNIFICANT).total() == 10002
+
+    with pytest.raises(Exception):
+        hdr.Histogram.open_mmap(path, LOWEST, HIGHEST, SIGNIFICANT + 1)
+
+    with pytest.raises(Exception):
+        hdr.Histogram.open_mmap(str(tmp_path / 'missing'))
+
+
+def test_benchmarks():
+    # a single call of each benchmark, to keep them working
+    layouts = {'test': (LOWEST, HIGHEST, SIGNIFICANT)}
+    current = hdr_benchmark.run(layouts=layouts, repeat=1, number=1, values=100)
+    result = current['results']['test']
+
+    assert len(result) == len(hdr_benchmark.BENCHMARKS) + 2
+    assert all(value > 0 for value in result.values())
+    assert result['memory_bytes'] > result['encoded_bytes']
+
+    assert 'record_ns_per_value' in result and 'iter_percentile_ns_per_call' in result
+
+    output = io.StringIO()
+    assert hdr_benchmark.report(current, current, threshold=1.25, output=output) == []
+    assert 'iter_percentile' in output.getvalue()
+
+    # a baseline of another environment is not compared
+    elsewhere = dict(current, environment=dict(current['environment'], numpy=not current['environment']['numpy']))
+    elsewhere['results'] = {'test': {name: value / 10 for name, value in result.items()}}
+    output = io.StringIO()
+    assert hdr_benchmark.report(current, elsewhere, threshold=1.25, output=output) == []
+    assert 'not compared' in output.getvalue()
+
+    # the committed baseline has the same benchmarks, it is of the python
+    # backend with numpy
+    with open(os.path.join(os.path.dirname(hdr_benchmark.__file__), 'hdr_benchmark.json')) as handler:
+        baseline = json.load(handler)
+    assert (baseline['backend'], baseline['environment']['numpy']) == ('python', True)
+    assert sorted(baseline['results']) == sorted(hdr_benchmark.LAYOUTS)
+    assert all(sorted(layout) == sorted(result) for layout in baseline['results'].values())
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import sys
 
-from setuptools import setup
+from setuptools import Extension, setup
 from setuptools.command.test import test
 
 
@@ -30,6 +30,9 @@ if __name__ == '__main__':
         license='MIT',
 
         py_modules=['hdr'],
+        # the native backend, hdr.py falls back to ctypes or pure python when
+        # the extension cannot be built
+        ext_modules=[Extension('_hdr', ['_hdr.c'], optional=True)],
         classifiers=[
             'Development Status :: 5 - Production/Stable',
             'Intended Audience :: Developers',